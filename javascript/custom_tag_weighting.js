@@ -1,4 +1,4 @@
-/* global gradioApp, onUiUpdate, onAfterUiUpdate */
+/* global gradioApp, onUiLoaded, onUiUpdate, onAfterUiUpdate */
 
 // --- Start of Custom Tag Weighting (CTW) specific JavaScript ---
 
@@ -10,74 +10,590 @@ const CTW_PROMPT_TEXTAREA_IDS = [
     // Standard A1111 IDs for Hires Fix prompts (these are component IDs, textarea is inside)
     "txt2img_hr_prompt",
     "txt2img_hr_negative_prompt"
-    // Add other known prompt component IDs if necessary (e.g., for inpainting)
 ];
 
-let ctwActiveTextarea = null; // Store the textarea being modified
+// Textareas the shortcuts apply to, matched when a key is pressed in them, so prompt boxes created later work too:
+// the IDs above, every Gradio textbox with the "prompt" class A1111 gives its prompts (inpaint and Hires fix
+// included), and any textarea an extension marks with a data-ctw-prompt attribute.
+const CTW_PROMPT_TEXTAREA_SELECTOR = [
+    ...CTW_PROMPT_TEXTAREA_IDS.map((id) => `#${id} textarea`),
+    ".prompt textarea",
+    "textarea[data-ctw-prompt]",
+].join(", ");
+
+const CTW_WEIGHT_STEP = 0.1; // Same default as the Python side
+
+// Shortcuts of the bulk operations, which rewrite every explicit weight of the selection, or of the whole prompt
+// without one. ctrl also matches Cmd. params are passed to the server as is, see BULK_OPERATIONS in tag_utils.py.
+// Ctrl/Cmd+Shift+Up/Down are left alone: they extend the selection to the start or end of the text on macOS.
+const CTW_BULK_SHORTCUTS = [
+    { alt: true, shift: true, code: "Equal", direction: "scale", params: { factor: 1.1 } },
+    { alt: true, shift: true, code: "Minus", direction: "scale", params: { factor: 1 / 1.1 } },
+    { alt: true, shift: true, code: "KeyR", direction: "reset" },
+    { alt: true, shift: true, code: "KeyN", direction: "normalize" },
+    { alt: true, shift: true, code: "KeyC", direction: "clamp", params: { min_weight: 0.5, max_weight: 1.5 } },
+    { alt: true, shift: true, code: "KeyD", direction: "round", params: { decimals: 1 } },
+    // Folds legacy emphasis such as ((((tag)))) or [[[[tag]]]] into explicit weights, see compact_segments in tag_utils.py.
+    { alt: true, shift: true, code: "KeyX", direction: "compact", params: { decimals: 2 } },
+];
+// Undo/redo of the edits made by this extension, which the browser's own Ctrl+Z cannot undo. Keys typed with AltGr,
+// which Windows reports as Ctrl+Alt, never match them.
+const CTW_HISTORY_SHORTCUTS = [
+    { ctrl: true, alt: true, code: "KeyZ", action: "undo" },
+    { ctrl: true, alt: true, code: "KeyY", action: "redo" },
+    { ctrl: true, alt: true, shift: true, code: "KeyZ", action: "redo" },
+];
+const CTW_HISTORY_SIZE = 100; // Undo steps kept per textarea, the oldest are dropped beyond that
+
+const CTW_REQUEST_TIMEOUT_MS = 5000; // A request without a reply by then is dropped so the textarea is not stuck
+const CTW_BUSY_RETRY_MS = 50; // Wait before resending a request the server was too busy to take
+
+// Direct routes registered by sd_custom_tag_weighting/api.py. The hidden Gradio components remain as a fallback.
+const CTW_API_URL = "./ctw/v1/weight";
+const CTW_WS_URL = "./ctw/v1/ws";
+const CTW_STATUS_URL = "./ctw/v1/status";
+
+let ctwApiAvailable = true; // Cleared when the routes answer 404 or cannot be reached
+let ctwSocket = null;
+
+// A socket that closes is reopened after CTW_SOCKET_RETRY_MS, doubled for each connection in a row refused before
+// it opened (a proxy without WebSocket support, or the auth check). After CTW_SOCKET_MAX_FAILURES refusals the
+// socket is given up and requests stay on POST.
+const CTW_SOCKET_RETRY_MS = 1000;
+const CTW_SOCKET_MAX_FAILURES = 5;
+let ctwSocketFailures = 0;
+let ctwSocketRetryTimer = null;
+
+// Every request carries a sequence number which the server echoes back. Only the reply to the latest request
+// of a textarea is applied; anything else is stale and dropped.
+let ctwRequestSeq = 0;
+const ctwPendingRequests = new Map(); // seq -> { textarea, promptText, viaSocket, action, timeoutId }
+
+// Per textarea: the request in flight and the actions pressed since it was sent, sent one request each in order.
+// An action is { direction: "step", steps, queuedAt } or { direction, params, queuedAt } for bulk operations.
+// Key-repeat presses of Ctrl+Up/Down arriving while a request is in flight are folded into one step action of
+// weight_step * n.
+// serverPromptText / serverPromptHash: the prompt the last reply produced and the server's hash of it. While the
+// textarea still holds that prompt, requests send the hash instead of the whole text.
+// history: the undo/redo ring buffer of ctwCreateHistory, and historyText the value the last edit or undo/redo left.
+const ctwTextareaStates = new WeakMap(); // textarea -> { inFlightSeq, queuedActions, serverPromptText, serverPromptHash, history, historyText }
+
+// Debug mode: verbose logging and per-stage timings. Off by default so neither slows down the key path.
+// Enable with localStorage.setItem("ctw-debug", "1") and a reload, or ctwSetDebug(true) from the console.
+let ctwDebug = false;
+try {
+    ctwDebug = window.localStorage.getItem("ctw-debug") === "1";
+} catch (e) {
+    // Storage can be unavailable, e.g. with cookies blocked
+}
+
+const CTW_TIMING_WINDOW = 256; // Samples kept per stage
+const ctwStageTimings = new Map(); // stage -> { samples, next, totalCount }
+
+function ctwDebugLog(...args) {
+    if (ctwDebug) {
+        console.log("CTW:", ...args);
+    }
+}
+
+function ctwRecordStage(stage, durationMs) {
+    if (!ctwDebug) {
+        return;
+    }
+    let timing = ctwStageTimings.get(stage);
+    if (!timing) {
+        timing = { samples: new Float64Array(CTW_TIMING_WINDOW), next: 0, totalCount: 0 };
+        ctwStageTimings.set(stage, timing);
+    }
+    timing.samples[timing.next] = durationMs;
+    timing.next = (timing.next + 1) % CTW_TIMING_WINDOW;
+    timing.totalCount++;
+}
 
-function ctwGetTagWeightRequestPayload(textarea, direction) {
-    return JSON.stringify({
-        prompt_text: textarea.value,
+function ctwSetDebug(enabled) {
+    ctwDebug = Boolean(enabled);
+    try {
+        window.localStorage.setItem("ctw-debug", ctwDebug ? "1" : "0");
+    } catch (e) {
+        // Not persisted, still applies to this page
+    }
+}
+
+// Debug panel: prints a table of the client stage timings over the last CTW_TIMING_WINDOW requests, then the
+// server side histograms from the status route when it is reachable. Returns the client table.
+function ctwLatencyReport() {
+    const table = {};
+    for (const [stage, timing] of ctwStageTimings) {
+        const samples = Array.from(timing.samples.subarray(0, Math.min(timing.totalCount, CTW_TIMING_WINDOW))).sort((a, b) => a - b);
+        const percentile = (fraction) => samples[Math.min(samples.length - 1, Math.floor(fraction * samples.length))].toFixed(2);
+        table[stage] = {
+            count: timing.totalCount,
+            p50_ms: percentile(0.5),
+            p90_ms: percentile(0.9),
+            p99_ms: percentile(0.99),
+            max_ms: samples[samples.length - 1].toFixed(2),
+        };
+    }
+    if (!ctwDebug) {
+        console.log("CTW: Timings are only recorded in debug mode, enable it with ctwSetDebug(true).");
+    }
+    console.table(table);
+    if (ctwApiAvailable) {
+        fetch(CTW_STATUS_URL)
+            .then((res) => res.json())
+            .then((status) => console.log("CTW: Server stage timings:", status.stages))
+            .catch(() => {});
+    }
+    return table;
+}
+
+window.ctwSetDebug = ctwSetDebug;
+window.ctwLatencyReport = ctwLatencyReport;
+
+const ctwElementCache = new Map(); // selector -> element, looked up again only once it leaves the DOM
+
+function ctwGetElement(selector) {
+    let element = ctwElementCache.get(selector);
+    if (!element || !element.isConnected) {
+        element = gradioApp().querySelector(selector);
+        if (element) {
+            ctwElementCache.set(selector, element);
+        }
+    }
+    return element;
+}
+
+function ctwGetTextareaState(textarea) {
+    let state = ctwTextareaStates.get(textarea);
+    if (!state) {
+        state = { inFlightSeq: null, queuedActions: [], serverPromptText: null, serverPromptHash: null, history: ctwCreateHistory(), historyText: null };
+        ctwTextareaStates.set(textarea, state);
+    }
+    return state;
+}
+
+function ctwConnectSocket() {
+    if (!ctwApiAvailable || !window.WebSocket) {
+        return;
+    }
+    if (ctwSocket && (ctwSocket.readyState === WebSocket.CONNECTING || ctwSocket.readyState === WebSocket.OPEN)) {
+        return;
+    }
+    const url = new URL(CTW_WS_URL, window.location.href);
+    url.protocol = url.protocol === "https:" ? "wss:" : "ws:";
+    const socket = new WebSocket(url.href);
+    let opened = false;
+    socket.onopen = () => {
+        opened = true;
+        ctwSocketFailures = 0;
+    };
+    socket.onmessage = (event) => ctwHandleResponseJson(event.data);
+    socket.onclose = () => {
+        if (ctwSocket === socket) {
+            ctwSocket = null;
+        }
+        // Requests still waiting on this socket are lost; later presses use POST until it is reopened.
+        for (const [seq, pending] of ctwPendingRequests) {
+            if (pending.viaSocket) {
+                ctwCompleteRequest(seq, null);
+            }
+        }
+        if (!opened) {
+            ctwSocketFailures++;
+        }
+        ctwScheduleSocketRetry();
+    };
+    ctwSocket = socket;
+}
+
+function ctwScheduleSocketRetry() {
+    if (ctwSocketRetryTimer !== null) {
+        return;
+    }
+    if (ctwSocketFailures >= CTW_SOCKET_MAX_FAILURES) {
+        console.warn(`CTW: WebSocket refused ${ctwSocketFailures} times in a row, using POST requests only.`);
+        return;
+    }
+    ctwSocketRetryTimer = setTimeout(() => {
+        ctwSocketRetryTimer = null;
+        ctwConnectSocket();
+    }, CTW_SOCKET_RETRY_MS * 2 ** ctwSocketFailures);
+}
+
+function ctwGetTagWeightRequestPayload(textarea, action, seq) {
+    const state = ctwGetTextareaState(textarea);
+    const request = {
+        ...action.params,
         cursor_pos_start: textarea.selectionStart,
-        cursor_pos_end: textarea.selectionEnd, // Keep for potential future use with selections
-        direction: direction,
-        // weight_step: 0.1 // Python side defaults this
-    });
+        cursor_pos_end: textarea.selectionEnd, // A selection reweights every tag it touches
+        seq: seq,
+        delta: true, // Reply with a splice rather than the whole new prompt
+        timing: ctwDebug, // Ask for the server stage timings along with the reply
+    };
+    if (action.direction === "step") {
+        request.direction = action.steps > 0 ? "up" : "down";
+        request.weight_step = Math.round(CTW_WEIGHT_STEP * Math.abs(action.steps) * 1000) / 1000;
+    } else {
+        request.direction = action.direction;
+    }
+    if (state.serverPromptHash !== null && textarea.value === state.serverPromptText) {
+        request.prompt_hash = state.serverPromptHash;
+    } else {
+        request.prompt_text = textarea.value;
+    }
+    return JSON.stringify(request);
+}
+
+function ctwFindShortcut(shortcuts, event) {
+    return shortcuts.find((shortcut) =>
+        event.code === shortcut.code &&
+        (event.ctrlKey || event.metaKey) === Boolean(shortcut.ctrl) &&
+        event.altKey === Boolean(shortcut.alt) &&
+        event.shiftKey === Boolean(shortcut.shift)
+    );
 }
 
 function ctwHandleCtrlWeight(event) {
     // console.log("CTW: ctwHandleCtrlWeight triggered for key:", event.key, "Ctrl:", event.ctrlKey, "Meta:", event.metaKey);
 
-    if (!((event.ctrlKey || event.metaKey) && (event.key === 'ArrowUp' || event.key === 'ArrowDown'))) {
+    // AltGr comes as Ctrl+Alt on Windows, so AltGr+Z (ż on Polish keyboards) would otherwise be taken for Ctrl+Alt+Z.
+    if (event.getModifierState && event.getModifierState("AltGraph")) {
+        return;
+    }
+    const bulkShortcut = ctwFindShortcut(CTW_BULK_SHORTCUTS, event);
+    const historyShortcut = !bulkShortcut && ctwFindShortcut(CTW_HISTORY_SHORTCUTS, event);
+    const isStep = (event.ctrlKey || event.metaKey) && !event.shiftKey && !event.altKey && (event.key === 'ArrowUp' || event.key === 'ArrowDown');
+    if (!bulkShortcut && !historyShortcut && !isStep) {
         return;
     }
 
     const textarea = event.target;
-    // Ensure this is one of the textareas we explicitly attached a listener to
-    if (!textarea.dataset.ctwKeydownAttached) {
-        // console.log("CTW: Event on textarea without ctwKeydownAttached dataset. Ignoring.", textarea);
+    if (textarea.tagName !== 'TEXTAREA' || !textarea.matches(CTW_PROMPT_TEXTAREA_SELECTOR)) {
         return;
     }
 
-    console.log(`CTW: Event Ctrl+${event.key} on target textarea:`, textarea.id || `(no id, placeholder: "${textarea.placeholder || 'N/A'}")`);
     event.preventDefault();
     event.stopPropagation();
 
-    ctwActiveTextarea = textarea;
-    const direction = event.key === 'ArrowUp' ? 'up' : 'down';
-    const payload = ctwGetTagWeightRequestPayload(textarea, direction);
-    console.log("CTW: Payload prepared:", payload);
+    const state = ctwGetTextareaState(textarea);
+    if (historyShortcut) {
+        ctwUndoRedo(textarea, historyShortcut.action === "redo");
+        return;
+    }
+    const lastAction = state.queuedActions[state.queuedActions.length - 1];
+    if (bulkShortcut) {
+        state.queuedActions.push({ direction: bulkShortcut.direction, params: bulkShortcut.params, queuedAt: performance.now() });
+    } else if (lastAction && lastAction.direction === "step") {
+        lastAction.steps += event.key === 'ArrowUp' ? 1 : -1;
+    } else {
+        state.queuedActions.push({ direction: "step", steps: event.key === 'ArrowUp' ? 1 : -1, queuedAt: performance.now() });
+    }
+    if (state.inFlightSeq === null) {
+        ctwFlushQueuedActions(textarea);
+    }
+}
+
+function ctwFlushQueuedActions(textarea) {
+    const state = ctwGetTextareaState(textarea);
+    let action = state.queuedActions.shift();
+    while (action && action.direction === "step" && action.steps === 0) {
+        action = state.queuedActions.shift(); // Presses cancelled each other out
+    }
+    if (!action) {
+        return;
+    }
+
+    const seq = ++ctwRequestSeq;
+    const buildStart = performance.now();
+    const payload = ctwGetTagWeightRequestPayload(textarea, action, seq);
+    const sentAt = performance.now();
+    ctwRecordStage("payload_build", sentAt - buildStart);
+    ctwDebugLog(`Sending request ${seq} (${action.direction === "step" ? `${action.steps} step(s)` : action.direction}) for textarea:`, textarea.id || textarea.placeholder);
+
+    state.inFlightSeq = seq;
+    ctwPendingRequests.set(seq, {
+        textarea: textarea,
+        promptText: textarea.value,
+        viaSocket: false,
+        transport: "http",
+        action: action,
+        sentAt: sentAt,
+        timeoutId: setTimeout(() => ctwCompleteRequest(seq, null), CTW_REQUEST_TIMEOUT_MS),
+    });
+    ctwSendTagWeightRequest(seq, payload);
+    ctwRecordStage("dispatch", performance.now() - sentAt);
+}
+
+function ctwCompleteRequest(seq, response, receivedAt) {
+    const pending = ctwPendingRequests.get(seq);
+    if (!pending) {
+        return; // Already answered or timed out
+    }
+    ctwPendingRequests.delete(seq);
+    clearTimeout(pending.timeoutId);
+    if (response !== null && receivedAt !== undefined) {
+        // Time from sending to the reply, per transport; for the Gradio bridge this ends when the MutationObserver fires.
+        ctwRecordStage(`reply_${pending.transport}`, receivedAt - pending.sentAt);
+        for (const [stage, durationUs] of Object.entries(response.server_timings_us || {})) {
+            ctwRecordStage(`server_${stage}`, durationUs / 1000);
+        }
+    }
+
+    const textarea = pending.textarea;
+    const state = ctwGetTextareaState(textarea);
+    if (state.inFlightSeq !== seq) {
+        return; // Superseded by a later request
+    }
+    state.inFlightSeq = null;
+
+    if (response === null) {
+        console.warn(`CTW: No reply to request ${seq}.`);
+    } else if (textarea.value !== pending.promptText) {
+        // The prompt was edited while the request was in flight; applying the reply would undo that edit.
+        ctwDebugLog(`Dropping reply to request ${seq}, the prompt changed meanwhile.`);
+        state.queuedActions = [];
+    } else if (response.unknown_prompt_hash) {
+        // The server no longer has the prompt cached; send the same action again with the full text.
+        ctwDebugLog(`Server does not know the prompt of request ${seq}, resending it in full.`);
+        state.serverPromptHash = null;
+        state.queuedActions.unshift(pending.action);
+    } else if (response.busy) {
+        // The server's request pool is full; try the same action again shortly, still ahead of later presses.
+        ctwDebugLog(`Server busy, retrying request ${seq} in ${CTW_BUSY_RETRY_MS} ms.`);
+        state.queuedActions.unshift(pending.action);
+        state.inFlightSeq = seq; // Holds later presses back until the retry
+        setTimeout(() => {
+            if (state.inFlightSeq === seq) {
+                state.inFlightSeq = null;
+                ctwFlushQueuedActions(textarea);
+            }
+        }, CTW_BUSY_RETRY_MS);
+        return;
+    } else {
+        const updateStart = performance.now();
+        ctwApplyTagWeightResponse(textarea, response);
+        const updatedAt = performance.now();
+        ctwRecordStage("textarea_update", updatedAt - updateStart);
+        ctwRecordStage("total", updatedAt - pending.action.queuedAt); // From the first key press this request carries
+    }
+
+    ctwFlushQueuedActions(textarea);
+}
 
+function ctwHandleResponseJson(responseJson, receivedAt = performance.now()) {
+    let response;
+    try {
+        response = JSON.parse(responseJson);
+    } catch (e) {
+        console.error("CTW: Failed to parse response JSON.", e, "JSON was:", responseJson);
+        return;
+    }
+    if (response.seq === undefined || !ctwPendingRequests.has(response.seq)) {
+        ctwDebugLog("Dropping stale or unknown reply:", response.seq);
+        return;
+    }
+    ctwCompleteRequest(response.seq, response, receivedAt);
+}
+
+function ctwSendTagWeightRequest(seq, payload) {
+    if (ctwSocket && ctwSocket.readyState === WebSocket.OPEN) {
+        const pending = ctwPendingRequests.get(seq);
+        pending.viaSocket = true;
+        pending.transport = "socket";
+        ctwSocket.send(payload);
+        return;
+    }
+    if (!ctwApiAvailable) {
+        ctwSendTagWeightRequestViaGradio(seq, payload);
+        return;
+    }
+
+    fetch(CTW_API_URL, { method: "POST", headers: { "Content-Type": "application/json" }, body: payload })
+        .then((res) => {
+            if (!res.ok) {
+                throw new Error(`HTTP ${res.status}`);
+            }
+            return res.text();
+        })
+        .then((responseJson) => ctwHandleResponseJson(responseJson))
+        .catch((e) => {
+            console.warn("CTW: Direct API request failed, falling back to the Gradio bridge.", e);
+            ctwApiAvailable = false;
+            ctwSendTagWeightRequestViaGradio(seq, payload);
+        });
+}
+
+function ctwSendTagWeightRequestViaGradio(seq, payload) {
+    const pending = ctwPendingRequests.get(seq);
+    if (pending) {
+        pending.transport = "gradio";
+    }
+    ctwSetupTagWeightResponseHandler();
     // Corrected elem_ids to match those defined in custom_tag_weighting.py
-    const reqTextbox = gradioApp().querySelector("#ctw-tag_weight_req_textbox textarea");
-    const actionButton = gradioApp().querySelector("#ctw-apply_tag_weight_action_button");
+    const reqTextbox = ctwGetElement("#ctw-tag_weight_req_textbox textarea");
+    const actionButton = ctwGetElement("#ctw-apply_tag_weight_action_button");
 
     if (!reqTextbox) {
         console.error("CTW: Request Textbox (#ctw-tag_weight_req_textbox textarea) not found.");
-        ctwActiveTextarea = null;
+        ctwCompleteRequest(seq, null);
         return;
     }
     if (!actionButton) {
         console.error("CTW: Action Button (#ctw-apply_tag_weight_action_button) not found.");
-        ctwActiveTextarea = null;
+        ctwCompleteRequest(seq, null);
         return;
     }
-    console.log("CTW: Gradio request textbox and action button found.");
 
     reqTextbox.value = payload;
     const inputEvent = new Event('input', { bubbles: true }); // Must be dispatched on the textarea itself
     reqTextbox.dispatchEvent(inputEvent);
-    console.log("CTW: Set request textbox value, dispatched input event.");
 
     actionButton.click();
-    console.log("CTW: Clicked action button. Waiting for response...");
+    ctwDebugLog("Clicked action button. Waiting for response...");
+}
+
+// Undo history of a textarea: a ring buffer of the last CTW_HISTORY_SIZE edits, each stored as the splice it made
+// { start, removed, inserted, selectionBefore, selectionAfter } rather than as a copy of the prompt. The last `undone`
+// entries are the ones that can be redone.
+function ctwCreateHistory() {
+    return { entries: new Array(CTW_HISTORY_SIZE), head: 0, count: 0, undone: 0 };
+}
+
+function ctwHistoryEntry(history, fromEnd) {
+    return history.entries[(history.head + history.count - 1 - fromEnd) % CTW_HISTORY_SIZE];
+}
+
+// Records the splice about to be made to textarea. Consecutive edits of the same tag merge into one undo step:
+// an edit merges with the previous one when nothing else changed the prompt in between and its span touches the
+// text the previous one inserted.
+function ctwRecordHistory(textarea, start, end, replacement, selectionAfter) {
+    const state = ctwGetTextareaState(textarea);
+    const history = state.history;
+    const text = textarea.value;
+    const afterUndo = history.undone > 0;
+    history.count -= history.undone; // A new edit forgets what was undone
+    history.undone = 0;
+
+    const last = history.count > 0 ? ctwHistoryEntry(history, 0) : null;
+    if (last && !afterUndo && state.historyText === text && start <= last.start + last.inserted.length && end >= last.start) {
+        // Widen both splices to the union of their spans in the current text, then combine them.
+        const low = Math.min(start, last.start);
+        const high = Math.max(end, last.start + last.inserted.length);
+        last.removed = text.slice(low, last.start) + last.removed + text.slice(last.start + last.inserted.length, high);
+        last.inserted = text.slice(low, start) + replacement + text.slice(end, high);
+        last.start = low;
+        last.selectionAfter = selectionAfter;
+        return;
+    }
+
+    if (history.count === CTW_HISTORY_SIZE) {
+        history.head = (history.head + 1) % CTW_HISTORY_SIZE; // Drop the oldest
+        history.count--;
+    }
+    history.entries[(history.head + history.count) % CTW_HISTORY_SIZE] = {
+        start: start,
+        removed: text.slice(start, end),
+        inserted: replacement,
+        selectionBefore: [textarea.selectionStart, textarea.selectionEnd],
+        selectionAfter: selectionAfter,
+    };
+    history.count++;
+}
+
+function ctwUndoRedo(textarea, redo) {
+    const state = ctwGetTextareaState(textarea);
+    const history = state.history;
+    if (redo ? history.undone === 0 : history.undone === history.count) {
+        return;
+    }
+    const entry = ctwHistoryEntry(history, redo ? history.undone - 1 : history.undone);
+    const [from, to] = redo ? [entry.removed, entry.inserted] : [entry.inserted, entry.removed];
+    if (textarea.value.slice(entry.start, entry.start + from.length) !== from) {
+        // The prompt was edited by hand since; the splice no longer applies, so the history is dropped.
+        ctwDebugLog("Prompt edited since the last weight change, clearing its undo history.");
+        state.history = ctwCreateHistory();
+        return;
+    }
+    state.queuedActions = []; // Presses queued against the current prompt no longer apply
+    history.undone += redo ? -1 : 1;
+
+    const oldScrollTop = textarea.scrollTop;
+    textarea.setRangeText(to, entry.start, entry.start + from.length);
+    const [selectionStart, selectionEnd] = redo ? entry.selectionAfter : entry.selectionBefore;
+    textarea.setSelectionRange(selectionStart, selectionEnd);
+    textarea.scrollTop = oldScrollTop;
+    state.historyText = textarea.value;
+    ctwNotifyInput(textarea);
+}
+
+// The span of oldText that differs from newText, as the splice that turns one into the other.
+function ctwDiffSplice(oldText, newText) {
+    let start = 0;
+    const maxCommon = Math.min(oldText.length, newText.length);
+    while (start < maxCommon && oldText[start] === newText[start]) {
+        start++;
+    }
+    let oldEnd = oldText.length;
+    let newEnd = newText.length;
+    while (oldEnd > start && newEnd > start && oldText[oldEnd - 1] === newText[newEnd - 1]) {
+        oldEnd--;
+        newEnd--;
+    }
+    return { start: start, end: oldEnd, replacement: newText.slice(start, newEnd) };
+}
+
+function ctwNotifyInput(textarea) {
+    if (window.updateInput) {
+        window.updateInput(textarea);
+        ctwDebugLog("Called window.updateInput().");
+    } else {
+        const inputEvent = new Event('input', { bubbles: true });
+        textarea.dispatchEvent(inputEvent);
+        ctwDebugLog("Dispatched input event as fallback.");
+    }
+}
+
+function ctwApplyTagWeightResponse(textarea, response) {
+    const hasSplice = response.splice !== undefined;
+    if (response.success && (hasSplice || response.new_prompt_text !== undefined)) {
+        const oldScrollTop = textarea.scrollTop;
+        const state = ctwGetTextareaState(textarea);
+
+        // Only the changed span is replaced, the rest of the textarea value is left alone.
+        const splice = hasSplice ? response.splice : ctwDiffSplice(textarea.value, response.new_prompt_text);
+        ctwDebugLog("Success. Splicing textarea:", splice.start, splice.end, splice.replacement);
+        ctwRecordHistory(textarea, splice.start, splice.end, splice.replacement, [response.selection_start, response.selection_end]);
+        textarea.setRangeText(splice.replacement, splice.start, splice.end);
+        state.historyText = textarea.value;
+        if (hasSplice) {
+            state.serverPromptText = textarea.value;
+            state.serverPromptHash = response.prompt_hash || null;
+        }
+
+        // The server gives the exact cursor, or the reweighted tags to keep selected for a selection request.
+        textarea.setSelectionRange(response.selection_start, response.selection_end);
+        ctwDebugLog("Textarea updated. New selection:", response.selection_start, response.selection_end);
+        textarea.scrollTop = oldScrollTop;
+        ctwNotifyInput(textarea);
+
+        if (response.compaction) {
+            const report = response.compaction;
+            console.log(`CTW: Emphasis compaction folded ${report.wrappers_folded} bracket pair(s): ` +
+                `${report.brackets_before} -> ${report.brackets_after} brackets, ${report.chars_before} -> ${report.chars_after} characters.`);
+        }
+
+    } else if (response.error) {
+        console.warn("CTW Error from Python: " + response.error);
+    } else {
+        console.warn("CTW: Response not successful or new_prompt_text missing.", response);
+    }
 }
 
 function ctwSetupTagWeightResponseHandler() {
-    const resTextbox = gradioApp().querySelector("#ctw-tag_weight_res_textbox textarea");
+    const resTextbox = ctwGetElement("#ctw-tag_weight_res_textbox textarea");
 
     if (!resTextbox) {
-        console.warn("CTW: Response Textbox (#ctw-tag_weight_res_textbox textarea) not found yet. Will retry on next UI update.");
+        console.warn("CTW: Response Textbox (#ctw-tag_weight_res_textbox textarea) not found yet. Will retry on the next request.");
         return false;
     }
 
@@ -88,62 +604,21 @@ function ctwSetupTagWeightResponseHandler() {
     console.log("CTW: Found response textbox. Setting up MutationObserver:", resTextbox);
 
     const observer = new MutationObserver((mutationsList, observerInstance) => {
-        if (!ctwActiveTextarea) {
+        if (ctwPendingRequests.size === 0) {
             return;
         }
-        console.log("CTW: MutationObserver fired for response textbox. Active textarea:", ctwActiveTextarea.id || `(no id, placeholder: "${ctwActiveTextarea.placeholder || 'N/A'}")`);
+        const receivedAt = performance.now();
 
         for(const mutation of mutationsList) {
             if (mutation.type === 'childList' || mutation.type === 'characterData' || mutation.type === 'attributes') {
                 const responseJson = resTextbox.value;
-                console.log("CTW: Response textbox value:", responseJson);
 
                 if (responseJson && responseJson.trim() !== "") {
-                    try {
-                        const response = JSON.parse(responseJson);
-                        console.log("CTW: Parsed response:", response);
-
-                        if (response.success && response.new_prompt_text !== undefined) {
-                            console.log("CTW: Success. Updating textarea with new prompt:", response.new_prompt_text);
-                            const oldScrollTop = ctwActiveTextarea.scrollTop;
-                            const oldSelectionStart = ctwActiveTextarea.selectionStart;
-                            const oldText = ctwActiveTextarea.value;
-                            const changeInLength = response.new_prompt_text.length - oldText.length;
-
-                            ctwActiveTextarea.value = response.new_prompt_text;
-
-                            const newCursorPos = Math.max(0, oldSelectionStart + changeInLength);
-
-                            ctwActiveTextarea.selectionStart = newCursorPos;
-                            ctwActiveTextarea.selectionEnd = newCursorPos;
-                            ctwActiveTextarea.scrollTop = oldScrollTop;
-                            console.log("CTW: Textarea updated. New cursor pos:", newCursorPos);
-
-                            if (window.updateInput) {
-                                window.updateInput(ctwActiveTextarea);
-                                console.log("CTW: Called window.updateInput().");
-                            } else {
-                                const inputEvent = new Event('input', { bubbles: true });
-                                ctwActiveTextarea.dispatchEvent(inputEvent);
-                                console.log("CTW: Dispatched input event as fallback.");
-                            }
-
-                        } else if (response.error) {
-                            console.warn("CTW Error from Python: " + response.error);
-                        } else {
-                            console.warn("CTW: Response not successful or new_prompt_text missing.", response);
-                        }
-                    } catch (e) {
-                        console.error("CTW: Failed to parse response JSON.", e, "JSON was:", responseJson);
-                    }
-
                     resTextbox.value = "";
                     const clearEvent = new Event('input', { bubbles: true });
                     resTextbox.dispatchEvent(clearEvent);
-                    // console.log("CTW: Cleared response textbox."); // Reduced verbosity
 
-                    ctwActiveTextarea = null;
-                    // console.log("CTW: Reset active textarea."); // Reduced verbosity
+                    ctwHandleResponseJson(responseJson, receivedAt);
                     break;
                 }
             }
@@ -156,49 +631,32 @@ function ctwSetupTagWeightResponseHandler() {
     return true;
 }
 
-function ctwAttachKeydownListeners() {
-    // console.log("CTW: Attempting to find and attach to prompt textareas...");
-    let actuallyAttachedCount = 0;
-
-    CTW_PROMPT_TEXTAREA_IDS.forEach(idFragment => {
-        const container = gradioApp().querySelector(`#${idFragment}`);
-        if (container) {
-            let textarea = (container.tagName === 'TEXTAREA') ? container : container.querySelector("textarea");
-            if (textarea) {
-                if (!textarea.dataset.ctwKeydownAttached) {
-                    textarea.addEventListener('keydown', ctwHandleCtrlWeight);
-                    textarea.dataset.ctwKeydownAttached = true;
-                    console.log(`CTW: Attached keydown listener to textarea in #${idFragment} (ID: ${textarea.id || 'N/A'}, Placeholder: "${textarea.placeholder || 'N/A'}")`);
-                    actuallyAttachedCount++;
-                }
-            } else {
-                 // console.warn(`CTW: Textarea not found within #${idFragment}`);
-            }
-        } else {
-             // console.warn(`CTW: Container element #${idFragment} not found for main prompts.`);
+// One keydown listener on the app root handles every prompt textarea, present or future, so nothing has to be
+// looked up or attached when the UI updates.
+function ctwAttachKeydownListener() {
+    const root = gradioApp();
+    if (!root || root.ctwKeydownAttached) {
+        return Boolean(root);
+    }
+    root.addEventListener('keydown', ctwHandleCtrlWeight);
+    root.ctwKeydownAttached = true;
+    console.log("CTW: Attached delegated keydown listener for prompt textareas matching:", CTW_PROMPT_TEXTAREA_SELECTOR);
+    return true;
+}
+
+if (window.onUiLoaded) {
+    onUiLoaded(ctwAttachKeydownListener);
+} else {
+    // Older WebUI versions: attach on the first UI update that has the app, then do nothing on the others.
+    let ctwListenerAttached = false;
+    (window.onAfterUiUpdate || window.onUiUpdate || (() => {}))(() => {
+        if (!ctwListenerAttached) {
+            ctwListenerAttached = ctwAttachKeydownListener();
         }
     });
-
-    if (actuallyAttachedCount > 0) {
-        // console.log(`CTW: Successfully attached/verified keydown listeners for ${actuallyAttachedCount} targeted textareas.`);
-    } else {
-        // console.warn("CTW: Could not find or attach to any of the primary prompt textareas using current selectors during this call. Will retry on UI update.");
-    }
 }
 
-// Standard A1111 UI update hook
-(
-  window.onAfterUiUpdate || window.onUiUpdate || (() => {}) // Fallback to empty function if neither exists
-)(() => {
-  // console.log("CTW: onUiUpdate triggered.");
-  ctwAttachKeydownListeners();
-  if (!window.ctwTagWeightResponseHandlerAttached) {
-    if (ctwSetupTagWeightResponseHandler()) {
-        window.ctwTagWeightResponseHandlerAttached = true;
-        console.log("CTW: Tag Weight Response Handler global flag set to true.");
-    }
-  }
-});
+ctwConnectSocket();
 
 console.log("Custom Tag Weighting (CTW) JavaScript loaded.");
 // --- End of Custom Tag Weighting (CTW) specific JavaScript ---
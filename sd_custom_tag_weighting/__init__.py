@@ -1,9 +1,27 @@
 # This file makes sd_custom_tag_weighting a Python package.
 # It can be empty or can be used to expose parts of the package.
 
-from .tag_utils import get_tag_at_cursor, apply_weight_to_tag
+from .tag_utils import (
+    get_tag_at_cursor, apply_weight_to_tag, apply_weight_to_segments, PromptSegmentIndex,
+    transform_weights, scale_weights, clamp_weights, reset_weights, normalize_weights, round_weights, compact_emphasis,
+)
+from .parse_cache import ParseCache
+from .request_handler import TagWeightRequestHandler
+from .executor import RequestExecutor
 
 __all__ = [
     "get_tag_at_cursor",
     "apply_weight_to_tag",
+    "apply_weight_to_segments",
+    "PromptSegmentIndex",
+    "transform_weights",
+    "scale_weights",
+    "clamp_weights",
+    "reset_weights",
+    "normalize_weights",
+    "round_weights",
+    "compact_emphasis",
+    "ParseCache",
+    "TagWeightRequestHandler",
+    "RequestExecutor",
 ]
@@ -0,0 +1,140 @@
+import argparse
+import random
+import sys
+import time
+from collections.abc import Callable, Iterator
+
+from .batch import ReweightSpec, reweight_prompt
+from .request_handler import MAX_PROMPT_LENGTH, TagWeightRequestHandler
+from .tag_utils import apply_weight_to_tag, compact_emphasis, get_tag_at_cursor
+
+DEFAULT_CORPUS_SIZE = 1 << 20 # Characters per prompt
+
+# Per-call time budget: a fixed allowance plus a linear one per character, for each pass the call makes over the
+# prompt (a parse, a walk of its nodes, ...). About 1.5 times the worst case measured on a slow machine, where
+# a parse of 1 MB of "(" takes 3 s, and far below what any quadratic behaviour would take at these sizes.
+CALL_BUDGET_BASE_MS = 50.0
+CALL_BUDGET_PER_CHAR_US = 4.0
+
+# Doubling the prompt may at most multiply a call's time by this much; a quadratic call would quadruple it.
+MAX_DOUBLING_RATIO = 3.5
+# Calls faster than this are too noisy to compare.
+MIN_SCALING_TIME_S = 0.05
+
+
+def _repeat(unit: str, size: int) -> str:
+    return unit * max(1, size // len(unit))
+
+
+def generate_adversarial_corpus(size: int = DEFAULT_CORPUS_SIZE, seed: int = 0) -> Iterator[tuple[str, str]]:
+    """
+    Yields (name, prompt) pairs of about size characters each, built to hit the worst case of every part of
+    the parser and of the weighting functions: deep and unbalanced nesting, huge numbers of separators,
+    tokens that start like syntax but never complete, and random garbage.
+    """
+    depth = max(1, size // 10)
+    yield "deep_weighted_nesting", "(" * depth + "tag" + ":1.1)" * depth
+    yield "deep_plain_nesting", "(" * depth + "tag" + ")" * depth
+    yield "unclosed_parens", _repeat("(", size)
+    yield "unclosed_mixed_brackets", _repeat("([", size)
+    yield "unclosed_parens_with_text", _repeat("(a", size)
+    yield "stray_closing_brackets", _repeat(")]", size)
+    yield "unbalanced_runs", _repeat("((((a)))))))", size)
+    yield "many_tags", _repeat("tag, ", size)
+    yield "many_empty_segments", _repeat(",", size)
+    yield "commas_in_unclosed_paren", "(" + _repeat("a,", size)
+    yield "keywords", _repeat("a AND b BREAK ", size)
+    yield "keyword_lookalikes", _repeat("ANDY BREAKS ", size)
+    yield "keyword_letters", _repeat("AB", size)
+    yield "colons_in_paren", "(" + _repeat(":1", size)
+    yield "long_weight", "(tag:" + _repeat("1", size)
+    yield "invalid_weights", _repeat("(a:1.2.3) ", size)
+    yield "unterminated_scheduling", _repeat("[a:", size)
+    yield "unterminated_extra_networks", _repeat("<lora:", size)
+    yield "extra_networks", _repeat("<lora:x,y:0.8>, ", size)
+    yield "escapes", _repeat("\\", size)
+    yield "escaped_brackets", _repeat("\\(\\[", size)
+    yield "whitespace", _repeat(" ", size)
+    yield "whitespace_weight", "(:" + _repeat(" ", size)
+    rng = random.Random(seed)
+    yield "random_syntax", "".join(rng.choice("ab ,()[]:|<>\\1.AND") for _ in range(size))
+
+
+def _timed_calls(prompt: str) -> Iterator[tuple[str, Callable[[], object], int]]:
+    """
+    Yields (label, call, work) for every entry point a pasted prompt can reach, work being the number of
+    characters the call goes through: the length of the prompt it handles times the passes it makes over it.
+    """
+    middle = len(prompt) // 2
+    for label, cursor_pos in (("start", 0), ("middle", middle), ("end", len(prompt))):
+        yield f"get_tag_at_cursor@{label}", lambda cursor_pos=cursor_pos: get_tag_at_cursor(prompt, cursor_pos), len(prompt)
+
+    def apply_at_middle():
+        tag, raw_start, raw_end = get_tag_at_cursor(prompt, middle)
+        return apply_weight_to_tag(prompt, tag, raw_start, raw_end, "up")
+    yield "apply_weight_to_tag@middle", apply_at_middle, 2 * len(prompt) # Parses the prompt, then the tag
+
+    # The handler refuses longer prompts outright, so it is timed on the longest it accepts as well. It parses
+    # the prompt and the rewritten span, and walks the nodes of both for the parse cache.
+    handled = prompt[:MAX_PROMPT_LENGTH]
+    payload = {"prompt_text": handled, "cursor_pos_start": len(handled) // 2, "direction": "up"}
+    yield "handler@middle", lambda: TagWeightRequestHandler().handle(payload), 3 * len(handled)
+    yield "handler@selection", lambda: TagWeightRequestHandler().handle(dict(payload, cursor_pos_start=0, cursor_pos_end=len(handled))), 3 * len(handled)
+    if len(prompt) > MAX_PROMPT_LENGTH:
+        too_long = {"prompt_text": prompt, "cursor_pos_start": middle, "direction": "up"}
+        yield "handler@too_long", lambda: TagWeightRequestHandler().handle(too_long), 0
+    yield "reweight_prompt", lambda: reweight_prompt(prompt, ReweightSpec(".*", direction="up")), len(prompt)
+    yield "compact_emphasis", lambda: compact_emphasis(prompt), len(prompt)
+
+
+def _time_call(call: Callable[[], object]) -> float:
+    start_time = time.perf_counter()
+    call()
+    return time.perf_counter() - start_time
+
+
+def check_time_budgets(size: int = DEFAULT_CORPUS_SIZE, check_scaling: bool = True, verbose: bool = True) -> list[str]:
+    """
+    Runs every call of _timed_calls over the adversarial corpus and returns a description of every budget
+    exceeded (empty if all calls are within budget). With check_scaling, each call is also timed on the
+    corpus at half the size, and must not grow faster than linearly beyond MAX_DOUBLING_RATIO.
+    """
+    half_corpus = dict(generate_adversarial_corpus(size // 2)) if check_scaling else {}
+    failures = []
+    for name, prompt in generate_adversarial_corpus(size):
+        half_calls = {label: call for label, call, _ in _timed_calls(half_corpus[name])} if check_scaling else {}
+        for label, call, work in _timed_calls(prompt):
+            budget = (CALL_BUDGET_BASE_MS + CALL_BUDGET_PER_CHAR_US * work / 1000.0) / 1000.0
+            elapsed = _time_call(call)
+            line = f"{name:30} {label:28} {len(prompt):>9} chars {elapsed * 1000:9.1f} ms (budget {budget * 1000:.0f} ms)"
+            if elapsed > budget:
+                failures.append(f"{line}: over budget")
+            if check_scaling and elapsed >= MIN_SCALING_TIME_S and label in half_calls:
+                half_elapsed = _time_call(half_calls[label])
+                ratio = elapsed / max(half_elapsed, 1e-9)
+                line += f", x{ratio:.1f} from half size"
+                if ratio > MAX_DOUBLING_RATIO:
+                    failures.append(f"{line}: grows faster than linearly")
+            if verbose:
+                print(line)
+    return failures
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m sd_custom_tag_weighting.adversarial",
+        description="Time the tag weighting functions on a generated corpus of pathological prompts."
+    )
+    parser.add_argument("-s", "--size", type=int, default=DEFAULT_CORPUS_SIZE, help=f"Characters per prompt (default: {DEFAULT_CORPUS_SIZE}).")
+    parser.add_argument("--no-scaling", action="store_true", help="Skip the comparison with the corpus at half the size.")
+    args = parser.parse_args(argv)
+
+    failures = check_time_budgets(args.size, check_scaling=not args.no_scaling)
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    print(f"{len(failures)} call(s) over budget.")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,117 @@
+import asyncio
+import base64
+import json
+import logging
+import secrets
+
+from fastapi import Depends, FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response
+from starlette.requests import HTTPConnection
+
+from .executor import RequestExecutor
+from .request_handler import EXTENSION_NAME
+
+API_PREFIX = "/ctw/v1"
+
+logger = logging.getLogger(__name__)
+
+
+class ApiAuth:
+    """
+    Access check of the routes, matching the WebUI's own. With --api-auth ("user:password,..."), requests need
+    HTTP Basic credentials from that list, as the WebUI's /sdapi routes do. With --gradio-auth, the session
+    cookie of a user logged in to the UI is accepted too, so the browser keeps using the routes. Without either,
+    every request is let through.
+    """
+
+    def __init__(self, app: FastAPI, api_auth: str | None = None):
+        self.app = app
+        self.credentials = {}
+        for entry in (api_auth or "").split(","):
+            if entry.strip():
+                user, _, password = entry.strip().partition(":")
+                self.credentials[user] = password
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.credentials) or bool(getattr(self.app, "auth", None))
+
+    def is_allowed(self, connection: HTTPConnection) -> bool:
+        if not self.enabled:
+            return True
+        return self._has_valid_credentials(connection.headers.get("authorization")) or self._has_valid_session(connection.cookies)
+
+    def _has_valid_credentials(self, authorization: str | None) -> bool:
+        scheme, _, encoded = (authorization or "").partition(" ")
+        if not self.credentials or scheme.lower() != "basic":
+            return False
+        try:
+            user, _, password = base64.b64decode(encoded, validate=True).decode("utf-8").partition(":")
+        except (ValueError, UnicodeDecodeError):
+            return False
+        expected = self.credentials.get(user)
+        return expected is not None and secrets.compare_digest(password.encode("utf-8"), expected.encode("utf-8"))
+
+    def _has_valid_session(self, cookies: dict[str, str]) -> bool:
+        # Gradio keeps the tokens of logged in users on its app, and names their cookies "access-token..."
+        tokens = getattr(self.app, "tokens", None) or {}
+        return any(name.startswith("access-token") and value in tokens for name, value in cookies.items())
+
+    def __call__(self, request: Request) -> None:
+        # No WWW-Authenticate challenge: the browser would show a login prompt instead of falling back to the
+        # Gradio bridge. Scripts send their credentials up front anyway.
+        if not self.is_allowed(request):
+            raise HTTPException(status_code=401, detail="Incorrect username or password")
+
+
+def register_api_routes(app: FastAPI, executor: RequestExecutor, api_auth: str | None = None) -> None:
+    """
+    Registers the tag weight routes on the WebUI's FastAPI app:
+    - POST {API_PREFIX}/weight: one request per call, same JSON payload and response as the Gradio bridge.
+    - WebSocket {API_PREFIX}/ws: persistent connection, one JSON text message per request, answered in order.
+    - GET {API_PREFIX}/status: rolling latency histograms of each stage of the requests handled so far,
+      and the counters of the parse cache and of the executor.
+    Both run the executor's handler on its own thread pool, without going through Gradio's queue or component
+    updates, and without blocking the event loop while it works.
+    Every route requires the same authentication as the WebUI, see ApiAuth; api_auth is its --api-auth option.
+    """
+    handler = executor.handler
+    auth = ApiAuth(app, api_auth)
+
+    @app.post(f"{API_PREFIX}/weight", dependencies=[Depends(auth)])
+    async def ctw_weight(request: Request):
+        # Decode and encode ourselves: the handler already speaks JSON, and skipping
+        # FastAPI's body validation and jsonable_encoder keeps the round trip short.
+        body = await request.body()
+        try:
+            request_json_str = body.decode("utf-8")
+        except UnicodeDecodeError as e:
+            # Same error reply as the handler's for a body it cannot decode
+            response_json = json.dumps({"success": False, "error": f"Request body is not valid UTF-8: {e}", "new_prompt_text": ""})
+        else:
+            response_json = await asyncio.wrap_future(executor.submit_json(request_json_str))
+        return Response(content=response_json, media_type="application/json")
+
+    @app.websocket(f"{API_PREFIX}/ws")
+    async def ctw_weight_ws(websocket: WebSocket):
+        if not auth.is_allowed(websocket):
+            await websocket.close(code=1008) # Policy violation
+            return
+        await websocket.accept()
+        try:
+            while True:
+                request_json_str = await websocket.receive_text()
+                await websocket.send_text(await asyncio.wrap_future(executor.submit_json(request_json_str)))
+        except WebSocketDisconnect:
+            pass
+
+    @app.get(f"{API_PREFIX}/status", dependencies=[Depends(auth)])
+    async def ctw_status():
+        return {
+            "extension": EXTENSION_NAME,
+            "stages": handler.metrics.snapshot(),
+            "parse_cache": handler.parse_cache.stats(),
+            "executor": executor.stats(),
+        }
+
+    logger.info(f"{EXTENSION_NAME}: Registered API routes under {API_PREFIX}")
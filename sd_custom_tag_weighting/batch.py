@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+from functools import partial
+from multiprocessing import Pool
+
+from .tag_utils import PromptSegmentIndex, splice_segments, weighted_segment_text
+
+DEFAULT_EXTENSIONS = (".txt", ".jsonl")
+
+
+@dataclass(frozen=True)
+class ReweightSpec:
+    """
+    What to reweight and how. Passed to the worker processes, so it must stay picklable.
+    - tag_pattern: Regular expression matched against the whole tag, without its weight.
+    - direction: "up" or "down", or None when weight is given.
+    - weight: Absolute weight to set instead of stepping.
+    - weight_step: How much to change the weight by when stepping.
+    - jsonl_keys: String fields of each JSONL record that hold prompts.
+    - dry_run: Count the changes without writing any file.
+    """
+    tag_pattern: str
+    direction: str | None = None
+    weight: float | None = None
+    weight_step: float = 0.1
+    jsonl_keys: tuple[str, ...] = ("prompt",)
+    dry_run: bool = False
+
+
+@dataclass
+class FileResult:
+    path: str
+    bytes_read: int = 0
+    tags_reweighted: int = 0
+    changed: bool = False
+    error: str | None = None
+
+
+def reweight_prompt(prompt_text: str, spec: ReweightSpec) -> tuple[str, int]:
+    """
+    Reweights every top-level tag of prompt_text whose base text matches spec.tag_pattern. Whitespace around
+    the whole prompt, such as the final newline of a caption file, is kept as it is.
+    Returns the new prompt and the number of tags whose text changed.
+    """
+    prompt_start = len(prompt_text) - len(prompt_text.lstrip())
+    prompt_end = len(prompt_text.rstrip())
+    if prompt_start >= prompt_end:
+        return prompt_text, 0
+    if prompt_start or prompt_end < len(prompt_text):
+        new_prompt_text, tags_reweighted = reweight_prompt(prompt_text[prompt_start:prompt_end], spec)
+        return prompt_text[:prompt_start] + new_prompt_text + prompt_text[prompt_end:], tags_reweighted
+
+    tag_regex = re.compile(spec.tag_pattern) # re keeps its own cache of compiled patterns
+    segment_index = PromptSegmentIndex(prompt_text)
+    replacements = []
+
+    for segment_idx in range(segment_index.segment_count):
+        raw_start, raw_end = segment_index.segment_bounds(segment_idx)
+        stripped_tag = prompt_text[raw_start:raw_end].strip()
+        if not stripped_tag:
+            continue
+        base_tag, current_weight = segment_index.segment_tag_weight(segment_idx)
+        if not tag_regex.fullmatch(base_tag):
+            continue
+
+        direction, weight_step, max_weight = spec.direction, spec.weight_step, 2.0
+        if spec.weight is not None:
+            direction = "up" if spec.weight >= current_weight else "down"
+            weight_step = abs(spec.weight - current_weight)
+            max_weight = max(max_weight, spec.weight)
+
+        middle_chunk = weighted_segment_text(
+            prompt_text,
+            stripped_tag,
+            raw_start,
+            raw_end,
+            direction,
+            weight_step,
+            max_weight,
+            (base_tag, current_weight)
+        )
+        if middle_chunk is None or middle_chunk.strip() == stripped_tag:
+            continue # Already at that weight: not counted, and its whitespace is left alone
+        replacements.append((raw_start, raw_end, middle_chunk))
+
+    return splice_segments(prompt_text, replacements)[0], len(replacements)
+
+
+def _reweight_jsonl(text: str, spec: ReweightSpec) -> tuple[str, int]:
+    tags_reweighted = 0
+    lines = text.splitlines(keepends=True)
+    for line_idx, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue # Leave lines we cannot parse untouched
+        if not isinstance(record, dict):
+            continue
+
+        record_changes = 0
+        for key in spec.jsonl_keys:
+            if isinstance(record.get(key), str):
+                record[key], count = reweight_prompt(record[key], spec)
+                record_changes += count
+        if record_changes:
+            line_ending = line[len(line.rstrip("\r\n")):]
+            lines[line_idx] = json.dumps(record, ensure_ascii=False) + line_ending
+            tags_reweighted += record_changes
+    return "".join(lines), tags_reweighted
+
+
+def atomic_write_bytes(path: str, pieces: Iterable[bytes]) -> None:
+    """
+    Writes the concatenated pieces to path through a temporary file in the same directory, so readers never see
+    a partial file. Binary files are written piece by piece so they never have to be in memory whole.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            for piece in pieces:
+                tmp_file.write(piece)
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def atomic_write_text(path: str, text: str) -> None:
+    """Writes text to path as UTF-8 with atomic_write_bytes, newlines as they are."""
+    atomic_write_bytes(path, (text.encode("utf-8"),))
+
+
+def process_file(path: str, spec: ReweightSpec) -> FileResult:
+    """Reweights one caption (.txt) or prompt log (.jsonl) file. Runs inside the worker processes."""
+    result = FileResult(path)
+    try:
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            text = f.read()
+        result.bytes_read = len(text.encode("utf-8"))
+
+        if path.endswith(".jsonl"):
+            new_text, result.tags_reweighted = _reweight_jsonl(text, spec)
+        else:
+            new_text, result.tags_reweighted = reweight_prompt(text, spec)
+
+        result.changed = new_text != text
+        if result.changed and not spec.dry_run:
+            atomic_write_text(path, new_text)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+def iter_files(paths: list[str], extensions: tuple[str, ...] = DEFAULT_EXTENSIONS):
+    """Yields the files given directly plus the matching files found under the given directories, lazily."""
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    if file_name.endswith(extensions):
+                        yield os.path.join(dir_path, file_name)
+        else:
+            yield path
+
+
+def add_reweight_arguments(parser: argparse.ArgumentParser, default_extensions: tuple[str, ...]) -> None:
+    """Adds the arguments shared by every batch reweighting command: paths, tag, weight and worker pool options."""
+    parser.add_argument("paths", nargs="+", help="Files or directories to process (directories are walked recursively).")
+    parser.add_argument("-t", "--tag", required=True, help="Regular expression matched against the whole tag, without its weight.")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("-d", "--direction", choices=["up", "down"], help="Step the weight of matching tags up or down.")
+    mode.add_argument("-w", "--weight", type=float, help="Set matching tags to this absolute weight.")
+    parser.add_argument("-s", "--step", type=float, default=0.1, help="Weight step used with --direction (default: 0.1).")
+    parser.add_argument("--ext", nargs="+", default=list(default_extensions), help="File extensions to pick up from directories.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="Worker processes (default: CPU count).")
+    parser.add_argument("--chunksize", type=int, default=64, help="Files handed to a worker at a time.")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Report what would change without writing.")
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m sd_custom_tag_weighting",
+        description="Reweight a tag across caption (.txt) and prompt log (.jsonl) files."
+    )
+    add_reweight_arguments(parser, DEFAULT_EXTENSIONS)
+    parser.add_argument("--jsonl-key", nargs="+", default=["prompt"], help="JSONL fields holding prompts (default: prompt).")
+    return parser
+
+
+def spec_from_args(args: argparse.Namespace, **spec_fields) -> ReweightSpec | None:
+    """Builds the ReweightSpec of the arguments of add_reweight_arguments, or prints why it cannot and returns None."""
+    try:
+        re.compile(args.tag)
+    except re.error as e:
+        print(f"Invalid --tag pattern: {e}", file=sys.stderr)
+        return None
+    return ReweightSpec(
+        tag_pattern=args.tag,
+        direction=args.direction,
+        weight=args.weight,
+        weight_step=args.step,
+        dry_run=args.dry_run,
+        **spec_fields
+    )
+
+
+def run_files(worker: Callable[[str], FileResult], files: Iterator[str], jobs: int, chunksize: int, dry_run: bool) -> int:
+    """
+    Runs worker over files, in a pool of jobs worker processes when jobs > 1, and prints the errors as they come
+    and a throughput summary at the end. worker must be picklable. Returns the exit status of the command.
+    """
+    files_done = files_changed = tags_reweighted = bytes_read = errors = 0
+    start_time = time.perf_counter()
+
+    def consume(results):
+        nonlocal files_done, files_changed, tags_reweighted, bytes_read, errors
+        for result in results:
+            files_done += 1
+            bytes_read += result.bytes_read
+            tags_reweighted += result.tags_reweighted
+            files_changed += result.changed
+            if result.error:
+                errors += 1
+                print(f"{result.path}: {result.error}", file=sys.stderr)
+
+    if jobs <= 1:
+        consume(map(worker, files))
+    else:
+        with Pool(processes=jobs) as pool:
+            consume(pool.imap_unordered(worker, files, chunksize=max(1, chunksize)))
+
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    action = "would change" if dry_run else "rewritten"
+    print(
+        f"{files_done} files ({files_changed} {action}), "
+        f"{tags_reweighted} tags reweighted, {errors} errors in {elapsed:.2f}s: "
+        f"{files_done / elapsed:.1f} files/s, {bytes_read / elapsed / 1e6:.2f} MB/s"
+    )
+    return 1 if errors else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_arg_parser().parse_args(argv)
+    spec = spec_from_args(args, jsonl_keys=tuple(args.jsonl_key))
+    if spec is None:
+        return 2
+    files = iter_files(args.paths, tuple(args.ext))
+    return run_files(partial(process_file, spec=spec), files, args.jobs, args.chunksize, args.dry_run)
+
+
+def _self_test() -> None:
+    up = ReweightSpec("blue hair|solo", direction="up")
+    assert reweight_prompt("solo, blue hair, (blue hair:1.5)", up) == ("(solo:1.1), (blue hair:1.1), (blue hair:1.6)", 3)
+    # The whitespace around a caption stays outside of its first and last tags.
+    assert reweight_prompt("solo\n", up) == ("(solo:1.1)\n", 1)
+    assert reweight_prompt("  1girl, solo \r\n", up) == ("  1girl, (solo:1.1) \r\n", 1)
+    assert reweight_prompt(" \n", up) == (" \n", 0)
+    # Tags already at the weight set are neither counted nor touched.
+    set_weight = ReweightSpec("smile", weight=1.1)
+    assert reweight_prompt("(smile:1.1) , smile, (smile:1.3)", set_weight) == ("(smile:1.1) , (smile:1.1), (smile:1.1)", 2)
+    assert reweight_prompt("(smile:1.1)", set_weight) == ("(smile:1.1)", 0)
+
+    assert _reweight_jsonl('{"prompt": "smile, cat"}\r\nnot json\n{"prompt": "cat"}', set_weight) == (
+        '{"prompt": "(smile:1.1), cat"}\r\nnot json\n{"prompt": "cat"}', 1
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        caption_path = os.path.join(directory, "caption.txt")
+        with open(caption_path, "w", encoding="utf-8", newline="") as f:
+            f.write("solo, smile\n")
+        dry_run = process_file(caption_path, ReweightSpec("smile", weight=1.1, dry_run=True))
+        assert (dry_run.changed, dry_run.tags_reweighted, dry_run.bytes_read, dry_run.error) == (True, 1, 12, None)
+        process_file(caption_path, set_weight)
+        with open(caption_path, encoding="utf-8", newline="") as f:
+            assert f.read() == "solo, (smile:1.1)\n"
+        unchanged = process_file(caption_path, set_weight)
+        assert not unchanged.changed and unchanged.tags_reweighted == 0
+        assert process_file(os.path.join(directory, "missing.txt"), set_weight).error.startswith("FileNotFoundError")
+    print("All batch tests passed.")
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["--self-test"]:
+        _self_test()
+    else:
+        raise SystemExit(main())
@@ -0,0 +1,236 @@
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable, Iterator
+from datetime import datetime, timezone
+
+from .request_handler import TagWeightRequestHandler
+from .tag_utils import apply_weight_to_tag, get_tag_at_cursor
+
+RESULTS_FORMAT_VERSION = 1
+
+CURSOR_FRACTIONS = (0.0, 0.25, 0.5, 0.75, 1.0)
+
+_TAG_WORDS = (
+    "1girl", "solo", "long hair", "blue eyes", "smile", "looking at viewer", "outdoors", "sky", "cloud",
+    "school uniform", "red ribbon", "holding umbrella", "cherry blossoms", "depth of field", "masterpiece",
+    "best quality", "detailed background", "sunset", "from side", "wind", "white dress", "night", "city lights",
+)
+
+
+def _random_tag(rng: random.Random, nesting: int = 0) -> str:
+    tag = rng.choice(_TAG_WORDS)
+    roll = rng.random()
+    if roll < 0.2:
+        tag = f"({tag}:{rng.choice((0.8, 0.9, 1.1, 1.2, 1.3))})"
+    elif roll < 0.3:
+        tag = f"({tag})"
+    elif roll < 0.35:
+        tag = f"[{tag}]"
+    for _ in range(nesting):
+        tag = f"({tag}:{rng.choice((0.9, 1.1, 1.2))})"
+    return tag
+
+
+def short_tag_list(rng: random.Random, tag_count: int) -> str:
+    """A typical hand-written prompt of a few tags."""
+    return ", ".join(_random_tag(rng) for _ in range(tag_count))
+
+
+def chunk_sized_prompt(rng: random.Random, chunk_count: int) -> str:
+    """Prompts of chunk_count 75-token CLIP chunks, roughly 25 tags each, joined with BREAK like A1111 users do."""
+    chunks = []
+    for _ in range(chunk_count):
+        tags = [_random_tag(rng) for _ in range(25)]
+        tags.insert(rng.randrange(len(tags)), f"<lora:style_{rng.randrange(100)}:{rng.choice((0.6, 0.8, 1))}>")
+        chunks.append(", ".join(tags))
+    return " BREAK ".join(chunks)
+
+
+def wildcard_expansion(rng: random.Random, char_count: int) -> str:
+    """The kind of prompt wildcard and dynamic prompt extensions expand to: long, with scheduling and alternation."""
+    parts = []
+    length = 0
+    while length < char_count:
+        roll = rng.random()
+        if roll < 0.1:
+            part = f"[{rng.choice(_TAG_WORDS)}:{rng.choice(_TAG_WORDS)}:{rng.choice((0.3, 0.5, 10))}]"
+        elif roll < 0.15:
+            part = f"[{rng.choice(_TAG_WORDS)}|{rng.choice(_TAG_WORDS)}]"
+        elif roll < 0.2:
+            part = f"({', '.join(_random_tag(rng) for _ in range(3))}:{rng.choice((1.1, 1.2))})"
+        else:
+            part = _random_tag(rng)
+        parts.append(part)
+        length += len(part) + 2
+    return ", ".join(parts)
+
+
+def nested_weights(rng: random.Random, depth: int) -> str:
+    """A few tags wrapped in depth levels of weights each, as left behind by repeated edits in older tools."""
+    return ", ".join(_random_tag(rng, nesting=depth) for _ in range(8))
+
+
+# name -> (generator, sizes swept); the size is the generator's second argument.
+CORPORA: dict[str, tuple[Callable[[random.Random, int], str], tuple[int, ...]]] = {
+    "short_tags": (short_tag_list, (5, 20)),
+    "chunk_75_tokens": (chunk_sized_prompt, (1, 3)),
+    "wildcard_expansion": (wildcard_expansion, (5000, 20000)),
+    "nested_weights": (nested_weights, (4, 16, 64)),
+}
+
+
+def _benchmarked_calls(prompt_text: str, cursor_pos: int) -> Iterator[tuple[str, Callable[[], object]]]:
+    """Yields (name, call) for every level measured, from the single lookup up to the JSON round trip."""
+    tag, raw_start, raw_end = get_tag_at_cursor(prompt_text, cursor_pos)
+    yield "get_tag_at_cursor", lambda: get_tag_at_cursor(prompt_text, cursor_pos)
+    yield "apply_weight_to_tag", lambda: apply_weight_to_tag(prompt_text, tag, raw_start, raw_end, "up")
+
+    # What process_tag_weight_request runs per call: JSON decode, handling and JSON encode.
+    # A new prompt every time, as when the user moves to another textarea or edits by hand...
+    request_json_str = json.dumps({"prompt_text": prompt_text, "cursor_pos_start": cursor_pos, "cursor_pos_end": cursor_pos, "direction": "up", "weight_step": 0.1})
+    yield "handle_json", lambda: TagWeightRequestHandler().handle_json(request_json_str)
+
+    # ...and repeated presses, where each request carries the prompt the previous one returned.
+    handler = TagWeightRequestHandler()
+    state = {"prompt_text": prompt_text, "direction": "up"}
+
+    def repeated_press():
+        request = {"prompt_text": state["prompt_text"], "cursor_pos_start": cursor_pos, "cursor_pos_end": cursor_pos, "direction": state["direction"], "weight_step": 0.1}
+        response = json.loads(handler.handle_json(json.dumps(request)))
+        state["prompt_text"] = response["new_prompt_text"]
+        state["direction"] = "down" if state["direction"] == "up" else "up" # Keeps the prompt from drifting
+        return response
+    yield "handle_json_repeated", repeated_press
+
+
+def _percentile(sorted_values: list[float], fraction: float) -> float:
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def measure(call: Callable[[], object], iterations: int, warmup: int = 3) -> dict:
+    """Times iterations calls, then traces the allocations of one more. Times are in microseconds."""
+    for _ in range(warmup):
+        call()
+    timings = []
+    for _ in range(iterations):
+        start_ns = time.perf_counter_ns()
+        call()
+        timings.append((time.perf_counter_ns() - start_ns) / 1000.0)
+    timings.sort()
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    allocation_blocks = sum(max(0, stat.count_diff) for stat in after.compare_to(before, "lineno"))
+
+    return {
+        "iterations": iterations,
+        "median_us": round(timings[len(timings) // 2], 3),
+        "p99_us": round(_percentile(timings, 0.99), 3),
+        "mean_us": round(sum(timings) / len(timings), 3),
+        "max_us": round(timings[-1], 3),
+        "alloc_peak_bytes": peak - baseline,
+        "alloc_retained_blocks": allocation_blocks,
+    }
+
+
+def run_benchmarks(iterations: int = 200, seed: int = 0, corpora: list[str] | None = None, functions: list[str] | None = None, verbose: bool = True) -> dict:
+    """
+    Runs every benchmarked call over the sweep of corpora, sizes and cursor positions.
+    Returns the results document main() writes as JSON.
+    """
+    results = []
+    for corpus_name, (generator, sizes) in CORPORA.items():
+        if corpora and corpus_name not in corpora:
+            continue
+        for size in sizes:
+            prompt_text = generator(random.Random(f"{seed}-{corpus_name}-{size}"), size)
+            for fraction in CURSOR_FRACTIONS:
+                cursor_pos = round(len(prompt_text) * fraction)
+                for function_name, call in _benchmarked_calls(prompt_text, cursor_pos):
+                    if functions and function_name not in functions:
+                        continue
+                    result = {
+                        "function": function_name,
+                        "corpus": corpus_name,
+                        "size": size,
+                        "prompt_chars": len(prompt_text),
+                        "cursor_fraction": fraction,
+                        **measure(call, iterations),
+                    }
+                    results.append(result)
+                    if verbose:
+                        print(_format_result(result))
+
+    return {
+        "format_version": RESULTS_FORMAT_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "iterations": iterations,
+        "seed": seed,
+        "results": results,
+    }
+
+
+def _result_key(result: dict) -> tuple:
+    return result["function"], result["corpus"], result["size"], result["cursor_fraction"]
+
+
+def _format_result(result: dict, baseline: dict | None = None) -> str:
+    line = (
+        f"{result['function']:22} {result['corpus']:20} size={result['size']:<6} cursor={result['cursor_fraction']:<5}"
+        f" median={result['median_us']:10.1f}us p99={result['p99_us']:10.1f}us peak={result['alloc_peak_bytes']:>9}B"
+    )
+    if baseline is not None:
+        line += f" median x{result['median_us'] / max(baseline['median_us'], 1e-9):.2f} p99 x{result['p99_us'] / max(baseline['p99_us'], 1e-9):.2f}"
+    return line
+
+
+def compare_results(results: dict, baseline: dict) -> list[str]:
+    """Formats every result next to its ratio to the matching result of an earlier run."""
+    baseline_by_key = {_result_key(result): result for result in baseline.get("results", [])}
+    return [_format_result(result, baseline_by_key.get(_result_key(result))) for result in results["results"]]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m sd_custom_tag_weighting.benchmark",
+        description="Benchmark tag lookups, weighting and the request handler on synthetic prompt corpora."
+    )
+    parser.add_argument("-o", "--output", help="JSON file to write the results to. Without it they are only printed.")
+    parser.add_argument("-n", "--iterations", type=int, default=200, help="Timed calls per measurement (default: 200).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic corpora.")
+    parser.add_argument("--corpus", nargs="+", choices=list(CORPORA), help="Only run these corpora.")
+    parser.add_argument("--function", nargs="+", help="Only run these functions, e.g. get_tag_at_cursor handle_json.")
+    parser.add_argument("--compare", help="Results file of an earlier run to print ratios against.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.iterations, args.seed, args.corpus, args.function, verbose=args.compare is None)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            for line in compare_results(results, json.load(f)):
+                print(line)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"{len(results['results'])} measurements written to {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
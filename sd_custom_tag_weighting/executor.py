@@ -0,0 +1,94 @@
+import json
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .request_handler import EXTENSION_NAME, TagWeightRequestHandler
+
+DEFAULT_MAX_WORKERS = 2
+# Requests running or waiting for a worker at most; beyond that they are answered "busy" right away.
+DEFAULT_MAX_PENDING = 16
+
+logger = logging.getLogger(__name__)
+
+
+class RequestExecutor:
+    """
+    Runs tag weight requests on a small thread pool of their own, apart from Gradio's queue and worker threads,
+    so key presses are answered while images generate and a flood of them cannot take the threads other
+    handlers need. Backpressure is by rejection: once max_pending requests are running or waiting, more are
+    answered {"success": false, "busy": true} at once instead of piling up, and the client retries shortly.
+    """
+
+    def __init__(self, handler: TagWeightRequestHandler, max_workers: int = DEFAULT_MAX_WORKERS, max_pending: int = DEFAULT_MAX_PENDING):
+        self.handler = handler
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ctw-weight")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.rejected = 0
+
+    def submit_json(self, request_json_str: str) -> "Future[str]":
+        """
+        Schedules handler.handle_json(request_json_str) and returns the future of its response. Never raises:
+        when the pool is saturated, the future is already done with the busy response.
+        Wait on it with .result() from a thread, or asyncio.wrap_future() from a coroutine.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                rejected = True
+            else:
+                self._pending += 1
+                rejected = False
+        if rejected:
+            logger.debug("%s: Tag weight request rejected, %d already pending.", EXTENSION_NAME, self.max_pending)
+            future = Future()
+            future.set_result(self._busy_response_json(request_json_str))
+            return future
+
+        future = self._executor.submit(self.handler.handle_json, request_json_str)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _future: Future) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    @staticmethod
+    def _busy_response_json(request_json_str: str) -> str:
+        response = {"success": False, "error": "Busy", "busy": True}
+        try:
+            data = json.loads(request_json_str)
+            if "seq" in data:
+                response["seq"] = data["seq"] # The client matches replies to requests by it
+        except (json.JSONDecodeError, TypeError, AttributeError):
+            pass
+        return json.dumps(response)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"max_workers": self.max_workers, "max_pending": self.max_pending, "pending": self._pending, "rejected": self.rejected}
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == '__main__':
+    release = threading.Event()
+
+    class _BlockingHandler:
+        def handle_json(self, request_json_str):
+            release.wait()
+            return request_json_str
+
+    executor = RequestExecutor(_BlockingHandler(), max_workers=1, max_pending=2)
+    futures = [executor.submit_json(json.dumps({"seq": seq})) for seq in range(3)]
+    busy = json.loads(futures[2].result(timeout=1))
+    assert busy == {"success": False, "error": "Busy", "busy": True, "seq": 2}
+    assert executor.stats()["pending"] == 2 and executor.rejected == 1
+    release.set()
+    assert [json.loads(future.result(timeout=1))["seq"] for future in futures[:2]] == [0, 1]
+    executor.shutdown()
+    print("All executor tests passed.")
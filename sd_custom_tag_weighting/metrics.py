@@ -0,0 +1,93 @@
+import threading
+from bisect import bisect_left
+
+# Upper bounds of the histogram buckets, in microseconds; a last bucket holds everything slower.
+BUCKET_BOUNDS_US = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000)
+
+DEFAULT_WINDOW = 1024 # Samples kept per stage
+
+
+class RollingHistogram:
+    """
+    Latency distribution of the last window samples of one stage.
+    Recording only writes into a ring buffer, so it is cheap enough for the request path;
+    buckets and percentiles are computed when a snapshot is taken.
+    """
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self._samples = [0.0] * window
+        self._next = 0
+        self.total_count = 0 # Samples ever recorded, including those that left the window
+
+    def record(self, value_us: float) -> None:
+        self._samples[self._next] = value_us
+        self._next = (self._next + 1) % len(self._samples)
+        self.total_count += 1
+
+    def snapshot(self) -> dict:
+        """Returns count, mean, p50/p90/p99 and max over the window (in microseconds) and the bucket counts."""
+        samples = sorted(self._samples[:min(self.total_count, len(self._samples))])
+        if not samples:
+            return {"count": 0, "total_count": self.total_count}
+
+        counts = [0] * (len(BUCKET_BOUNDS_US) + 1)
+        for value in samples:
+            counts[bisect_left(BUCKET_BOUNDS_US, value)] += 1
+        labels = [f"<={bound}" for bound in BUCKET_BOUNDS_US] + [f">{BUCKET_BOUNDS_US[-1]}"]
+
+        def percentile(fraction):
+            return round(samples[min(len(samples) - 1, int(fraction * len(samples)))], 1)
+
+        return {
+            "count": len(samples),
+            "total_count": self.total_count,
+            "mean_us": round(sum(samples) / len(samples), 1),
+            "p50_us": percentile(0.5),
+            "p90_us": percentile(0.9),
+            "p99_us": percentile(0.99),
+            "max_us": round(samples[-1], 1),
+            "buckets_us": {label: count for label, count in zip(labels, counts) if count},
+        }
+
+
+class StageMetrics:
+    """Rolling latency histograms of named stages, e.g. "json_parse" or "weight_apply". Thread-safe."""
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self._window = window
+        self._histograms: dict[str, RollingHistogram] = {}
+        self._lock = threading.Lock()
+
+    def record_ns(self, stage: str, duration_ns: int) -> None:
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = RollingHistogram(self._window)
+            histogram.record(duration_ns / 1000.0)
+
+    def snapshot(self) -> dict[str, dict]:
+        with self._lock:
+            return {stage: histogram.snapshot() for stage, histogram in self._histograms.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+
+
+if __name__ == '__main__':
+    histogram = RollingHistogram(window=4)
+    for value in (5, 15, 150, 3000, 7):
+        histogram.record(value)
+    snapshot = histogram.snapshot()
+    print(snapshot)
+    assert snapshot["count"] == 4 and snapshot["total_count"] == 5 # 5 fell out of the window
+    assert snapshot["max_us"] == 3000 and snapshot["p50_us"] == 150
+    assert snapshot["buckets_us"] == {"<=10": 1, "<=20": 1, "<=200": 1, "<=5000": 1}
+    assert RollingHistogram().snapshot() == {"count": 0, "total_count": 0}
+
+    metrics = StageMetrics()
+    metrics.record_ns("json_parse", 12_000)
+    assert metrics.snapshot()["json_parse"]["p99_us"] == 12.0
+    metrics.reset()
+    assert metrics.snapshot() == {}
+    print("All metrics tests passed.")
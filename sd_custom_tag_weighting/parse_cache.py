@@ -0,0 +1,142 @@
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+
+from .tag_utils import PromptSegmentIndex
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 32 << 20
+
+# Rough memory cost of the parse of a prompt, measured with tracemalloc on CPython 3.11.
+_NODE_BYTES = 128    # PromptNode with its children list
+_SEGMENT_BYTES = 96  # Node list of a segment and its entries in the separator lists
+
+
+def prompt_hash(prompt_text: str) -> bytes:
+    # surrogatepass: a prompt decoded from JSON can hold lone surrogates, which must not make hashing fail.
+    return hashlib.blake2b(prompt_text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+def estimate_index_size(segment_index: PromptSegmentIndex) -> int:
+    """Approximate number of bytes a PromptSegmentIndex keeps alive, prompt text included."""
+    node_count = 0
+    pending = [nodes for nodes in segment_index.segments]
+    while pending: # Iterative, nesting can be arbitrarily deep
+        nodes = pending.pop()
+        node_count += len(nodes)
+        pending.extend(node.children for node in nodes if node.children)
+    return sys.getsizeof(segment_index.prompt_text) + node_count * _NODE_BYTES + segment_index.segment_count * _SEGMENT_BYTES
+
+
+class ParseCache:
+    """
+    Thread-safe LRU cache of PromptSegmentIndex objects keyed by a hash of their prompt, bounded both by
+    number of entries and by their approximate total size. Cached indexes are shared between requests,
+    so they must not be modified; derive updated ones with PromptSegmentIndex.replaced.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[bytes, tuple[PromptSegmentIndex, int]] = OrderedDict() # Least recently used first
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, prompt_text: str) -> PromptSegmentIndex | None:
+        key = prompt_hash(prompt_text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0].prompt_text != prompt_text: # Also guards against hash collisions
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_by_hash(self, key: bytes) -> PromptSegmentIndex | None:
+        """Looks up a prompt by its prompt_hash alone, for clients that only send the hash of a prompt the server returned."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, segment_index: PromptSegmentIndex) -> None:
+        """Caches segment_index as the most recently used entry, evicting the least recently used ones to make room."""
+        size = estimate_index_size(segment_index)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return # Would evict everything else and still not fit
+        key = prompt_hash(segment_index.prompt_text)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous[1]
+            self._entries[key] = (segment_index, size)
+            self._total_bytes += size
+            while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_parse(self, prompt_text: str) -> PromptSegmentIndex:
+        segment_index = self.get(prompt_text)
+        if segment_index is None:
+            segment_index = PromptSegmentIndex(prompt_text)
+            self.put(segment_index)
+        return segment_index
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+if __name__ == '__main__':
+    cache = ParseCache(max_entries=2)
+    first = cache.get_or_parse("tag1, tag2")
+    assert cache.get_or_parse("tag1, tag2") is first
+    cache.get_or_parse("a, b")
+    cache.get_or_parse("c") # Evicts "tag1, tag2", the least recently used
+    assert cache.get("tag1, tag2") is None
+    assert cache.get("a, b") is not None
+    stats = cache.stats()
+    print(stats)
+    assert (stats["entries"], stats["hits"], stats["misses"], stats["evictions"]) == (2, 2, 4, 1)
+
+    # An edited prompt goes straight into the cache, and the index it came from is left as it was.
+    edited = first.replaced("(tag1:1.1), tag2", 0, 4)
+    cache.put(edited)
+    assert cache.get("(tag1:1.1), tag2") is edited
+    assert first.prompt_text == "tag1, tag2" and first.separator_starts == [4]
+    assert cache.get_by_hash(prompt_hash("(tag1:1.1), tag2")) is edited
+    assert cache.get_by_hash(prompt_hash("not cached")) is None
+
+    small_cache = ParseCache(max_bytes=estimate_index_size(first) * 2)
+    small_cache.put(first)
+    small_cache.put(PromptSegmentIndex("x" * 10000)) # Larger than the whole cache, not kept
+    assert small_cache.stats()["entries"] == 1
+    small_cache.put(PromptSegmentIndex("tag3, tag4"))
+    small_cache.put(PromptSegmentIndex("tag5, tag6")) # Over the byte bound, evicts
+    assert small_cache.stats()["bytes"] <= small_cache.max_bytes and small_cache.evictions >= 1
+    print("All parse_cache tests passed.")
@@ -0,0 +1,296 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import zlib
+from collections.abc import Iterator
+from dataclasses import dataclass
+from functools import partial
+
+from .batch import FileResult, ReweightSpec, add_reweight_arguments, atomic_write_bytes, iter_files, reweight_prompt, run_files, spec_from_args
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PARAMETERS_KEYWORD = b"parameters" # Where A1111 stores the generation parameters of an image
+NEGATIVE_PROMPT_PREFIX = "Negative prompt: "
+SETTINGS_PREFIX = "Steps: "
+
+_CHUNK_HEADER = struct.Struct(">I4s")
+_CRC = struct.Struct(">I")
+_TEXT_CHUNK_TYPES = (b"tEXt", b"zTXt", b"iTXt")
+
+
+@dataclass
+class TextChunk:
+    """
+    The "parameters" chunk of a PNG file, located by find_parameters_chunk.
+    - start, end: Offsets of the whole chunk in the file, length and CRC included.
+    - chunk_type: b"tEXt", b"zTXt" or b"iTXt".
+    - text: The decoded parameters text.
+    - itxt_header: For iTXt, the compression flag and method, language tag and translated keyword as stored.
+    """
+    start: int
+    end: int
+    chunk_type: bytes
+    text: str
+    itxt_header: bytes = b""
+
+
+def find_parameters_chunk(data) -> TextChunk | None:
+    """
+    Walks the chunks of a PNG file held in data (bytes or an mmap) and returns its "parameters" text chunk,
+    or None if it has none. Only chunk headers are read on the way: image data is skipped, never decoded.
+    Raises ValueError if data is not a PNG file or the chunk is damaged.
+    """
+    if data[:len(PNG_SIGNATURE)] != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+    keyword_prefix = PARAMETERS_KEYWORD + b"\0"
+    offset = len(PNG_SIGNATURE)
+    while offset + _CHUNK_HEADER.size <= len(data):
+        length, chunk_type = _CHUNK_HEADER.unpack_from(data, offset)
+        data_start = offset + _CHUNK_HEADER.size
+        chunk_end = data_start + length + _CRC.size
+        if chunk_end > len(data):
+            raise ValueError(f"Truncated {chunk_type!r} chunk at offset {offset}")
+        if chunk_type in _TEXT_CHUNK_TYPES and data[data_start:data_start + len(keyword_prefix)] == keyword_prefix:
+            chunk_data = data[data_start:data_start + length]
+            if zlib.crc32(chunk_type + chunk_data) != _CRC.unpack_from(data, data_start + length)[0]:
+                raise ValueError(f"CRC mismatch in the {chunk_type.decode()} parameters chunk")
+            return _decode_text_chunk(offset, chunk_end, chunk_type, chunk_data[len(keyword_prefix):])
+        if chunk_type == b"IEND":
+            break
+        offset = chunk_end
+    return None
+
+
+def _decode_text_chunk(start: int, end: int, chunk_type: bytes, body: bytes) -> TextChunk:
+    # body is the chunk data after the keyword and its null separator.
+    if chunk_type == b"tEXt":
+        return TextChunk(start, end, chunk_type, body.decode("latin-1"))
+    if chunk_type == b"zTXt":
+        return TextChunk(start, end, chunk_type, zlib.decompress(body[1:]).decode("latin-1"))
+    # iTXt: compression flag, compression method, language tag\0, translated keyword\0, text
+    language_end = body.index(b"\0", 2)
+    header_end = body.index(b"\0", language_end + 1) + 1
+    text = body[header_end:]
+    if body[0]:
+        text = zlib.decompress(text)
+    return TextChunk(start, end, chunk_type, text.decode("utf-8"), body[:header_end])
+
+
+def encode_text_chunk(chunk: TextChunk, new_text: str) -> bytes:
+    """
+    Encodes new_text as a whole chunk (length, type, data and CRC) replacing chunk, of the same type and
+    compression. A tEXt or zTXt chunk becomes an iTXt one if new_text does not fit in Latin-1, as Pillow does.
+    """
+    chunk_type = chunk.chunk_type
+    itxt_header = chunk.itxt_header
+    if chunk_type != b"iTXt":
+        try:
+            latin1_text = new_text.encode("latin-1")
+        except UnicodeEncodeError:
+            itxt_header = (b"\x01\x00" if chunk_type == b"zTXt" else b"\x00\x00") + b"\0\0"
+            chunk_type = b"iTXt"
+
+    if chunk_type == b"tEXt":
+        body = latin1_text
+    elif chunk_type == b"zTXt":
+        body = b"\x00" + zlib.compress(latin1_text)
+    else:
+        body = itxt_header + (zlib.compress(new_text.encode("utf-8")) if itxt_header[0] else new_text.encode("utf-8"))
+
+    chunk_data = PARAMETERS_KEYWORD + b"\0" + body
+    return _CHUNK_HEADER.pack(len(chunk_data), chunk_type) + chunk_data + _CRC.pack(zlib.crc32(chunk_type + chunk_data))
+
+
+def reweight_parameters(parameters: str, spec: ReweightSpec, include_negative: bool = False) -> tuple[str, int]:
+    """
+    Reweights the prompt of an A1111 parameters text, and its negative prompt with include_negative.
+    The settings line ("Steps: ...") is left as it is. Returns the new text and the number of tags reweighted.
+    """
+    settings = ""
+    settings_start = parameters.rfind("\n")
+    if settings_start >= 0 and parameters.startswith(SETTINGS_PREFIX, settings_start + 1):
+        parameters, settings = parameters[:settings_start], parameters[settings_start:]
+
+    if parameters.startswith(NEGATIVE_PROMPT_PREFIX):
+        negative_start = 0
+    else:
+        negative_start = parameters.find("\n" + NEGATIVE_PROMPT_PREFIX)
+        negative_start = len(parameters) if negative_start < 0 else negative_start
+    prompt, negative = parameters[:negative_start], parameters[negative_start:]
+
+    new_prompt, tags_reweighted = reweight_prompt(prompt, spec)
+    if include_negative and negative:
+        negative_prompt_start = negative.index(NEGATIVE_PROMPT_PREFIX) + len(NEGATIVE_PROMPT_PREFIX)
+        new_negative_prompt, negative_tags_reweighted = reweight_prompt(negative[negative_prompt_start:], spec)
+        negative = negative[:negative_prompt_start] + new_negative_prompt
+        tags_reweighted += negative_tags_reweighted
+    return new_prompt + negative + settings, tags_reweighted
+
+
+def _spliced_file(path: str, start: int, end: int, replacement: bytes) -> Iterator[bytes]:
+    """
+    Yields the pieces of the file at path with its bytes [start, end) replaced. The pieces around the replacement
+    are views of the file's mapping, so they go to the writer without being copied, and the mapping is closed
+    once they are all written: a file still mapped could not be replaced on Windows.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+        with view[:start] as head:
+            yield head
+        yield replacement
+        with view[end:] as tail:
+            yield tail
+
+
+def process_png(path: str, spec: ReweightSpec, include_negative: bool = False) -> FileResult:
+    """
+    Reweights the prompt in the parameters chunk of one PNG file. Runs inside the worker processes.
+    The file is memory-mapped and only the text chunk is rewritten: in place when its length does not change,
+    otherwise by copying the other chunks around it, as they are, into a new file that replaces it.
+    """
+    result = FileResult(path)
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            result.bytes_read = len(data)
+            chunk = find_parameters_chunk(data)
+        if chunk is None:
+            return result
+        new_text, result.tags_reweighted = reweight_parameters(chunk.text, spec, include_negative)
+        result.changed = new_text != chunk.text
+        if not result.changed or spec.dry_run:
+            return result
+
+        new_chunk = encode_text_chunk(chunk, new_text)
+        if len(new_chunk) == chunk.end - chunk.start:
+            with open(path, "r+b") as f:
+                f.seek(chunk.start)
+                f.write(new_chunk)
+        else:
+            atomic_write_bytes(path, _spliced_file(path, chunk.start, chunk.end, new_chunk))
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m sd_custom_tag_weighting.png_metadata",
+        description="Reweight a tag in the prompts A1111 embeds in its PNG files, without decoding the images."
+    )
+    add_reweight_arguments(parser, (".png",))
+    parser.add_argument("--negative", action="store_true", help="Also reweight the negative prompts.")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_arg_parser().parse_args(argv)
+    spec = spec_from_args(args)
+    if spec is None:
+        return 2
+    files = iter_files(args.paths, tuple(args.ext))
+    worker = partial(process_png, spec=spec, include_negative=args.negative)
+    return run_files(worker, files, args.jobs, args.chunksize, args.dry_run)
+
+
+def _self_test() -> None:
+    def chunk_bytes(chunk_type: bytes, chunk_data: bytes) -> bytes:
+        return _CHUNK_HEADER.pack(len(chunk_data), chunk_type) + chunk_data + _CRC.pack(zlib.crc32(chunk_type + chunk_data))
+
+    header = PNG_SIGNATURE + chunk_bytes(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+    footer = chunk_bytes(b"IDAT", zlib.compress(b"\0\xff\0\0")) + chunk_bytes(b"IEND", b"")
+    parameters = "solo, (smile:1.1)\nNegative prompt: smile, lowres\nSteps: 20, Sampler: Euler a, Prompt: \"smile\""
+    keyword = PARAMETERS_KEYWORD + b"\0"
+    latin1_text = parameters.encode("latin-1")
+    text_chunks = {
+        "tEXt": chunk_bytes(b"tEXt", keyword + latin1_text),
+        "zTXt": chunk_bytes(b"zTXt", keyword + b"\x00" + zlib.compress(latin1_text)),
+        "iTXt": chunk_bytes(b"iTXt", keyword + b"\x00\x00en\0parameters\0" + parameters.encode("utf-8")),
+        "compressed iTXt": chunk_bytes(b"iTXt", keyword + b"\x01\x00\0\0" + zlib.compress(parameters.encode("utf-8"))),
+    }
+
+    for name, text_chunk in text_chunks.items():
+        data = header + text_chunk + footer
+        chunk = find_parameters_chunk(data)
+        assert (chunk.start, chunk.end, chunk.text) == (len(header), len(header) + len(text_chunk), parameters), name
+        # Encoding the text it holds gives the chunk back, byte for byte, CRC included.
+        assert encode_text_chunk(chunk, parameters) == text_chunk, name
+        new_text = parameters.replace("solo", "猫")
+        new_chunk = find_parameters_chunk(header + encode_text_chunk(chunk, new_text) + footer)
+        assert new_chunk.text == new_text, name
+        damaged = bytearray(data)
+        damaged[chunk.end - 1] ^= 0xff
+        try:
+            find_parameters_chunk(damaged)
+            assert False, name
+        except ValueError:
+            pass
+    # Text that Latin-1 cannot hold promotes tEXt and zTXt to iTXt, keeping the compression.
+    promoted = find_parameters_chunk(header + encode_text_chunk(find_parameters_chunk(header + text_chunks["tEXt"] + footer), "猫") + footer)
+    assert (promoted.chunk_type, promoted.itxt_header, promoted.text) == (b"iTXt", b"\x00\x00\0\0", "猫")
+    promoted = find_parameters_chunk(header + encode_text_chunk(find_parameters_chunk(header + text_chunks["zTXt"] + footer), "猫") + footer)
+    assert (promoted.chunk_type, promoted.itxt_header, promoted.text) == (b"iTXt", b"\x01\x00\0\0", "猫")
+    assert find_parameters_chunk(header + footer) is None
+    try:
+        find_parameters_chunk(b"GIF89a" + footer)
+        assert False
+    except ValueError:
+        pass
+
+    # The settings line is kept as it is, even where it names a tag, and the negative prompt only on request.
+    smile = ReweightSpec("smile", direction="up")
+    assert reweight_parameters(parameters, smile) == (parameters.replace("(smile:1.1)", "(smile:1.2)"), 1)
+    assert reweight_parameters(parameters, smile, include_negative=True) == (
+        "solo, (smile:1.2)\nNegative prompt: (smile:1.1), lowres\nSteps: 20, Sampler: Euler a, Prompt: \"smile\"", 2
+    )
+    assert reweight_parameters("Negative prompt: smile", smile, include_negative=True) == ("Negative prompt: (smile:1.1)", 1)
+    assert reweight_parameters("smile\nSteps: 20", smile) == ("(smile:1.1)\nSteps: 20", 1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "image.png")
+        for name, text_chunk in text_chunks.items():
+            original = header + text_chunk + footer
+            with open(path, "wb") as f:
+                f.write(original)
+            dry_run = process_png(path, ReweightSpec("smile", direction="up", dry_run=True))
+            assert (dry_run.changed, dry_run.tags_reweighted, dry_run.bytes_read, dry_run.error) == (True, 1, len(original), None), name
+            with open(path, "rb") as f:
+                assert f.read() == original, name
+
+            # "(smile:1.1)" becoming "(smile:1.2)" keeps the length of an uncompressed chunk, which is rewritten in place.
+            file_id = os.stat(path).st_ino
+            result = process_png(path, smile)
+            assert (result.changed, result.tags_reweighted, result.error) == (True, 1, None), name
+            with open(path, "rb") as f:
+                data = f.read()
+            if name in ("tEXt", "iTXt"):
+                assert os.stat(path).st_ino == file_id, name
+                assert len(data) == len(original), name
+            chunk = find_parameters_chunk(data)
+            assert chunk.text == parameters.replace("(smile:1.1)", "(smile:1.2)"), name
+            assert data[:chunk.start] == header and data[chunk.end:] == footer, name
+
+            # Reweighting the negative prompt too lengthens the chunk: the file is rebuilt around it.
+            result = process_png(path, smile, include_negative=True)
+            assert (result.changed, result.tags_reweighted, result.error) == (True, 2, None), name
+            with open(path, "rb") as f:
+                data = f.read()
+            chunk = find_parameters_chunk(data)
+            assert chunk.text == "solo, (smile:1.3)\nNegative prompt: (smile:1.1), lowres\nSteps: 20, Sampler: Euler a, Prompt: \"smile\"", name
+            assert data[:chunk.start] == header and data[chunk.end:] == footer, name
+
+        with open(path, "wb") as f:
+            f.write(header + footer)
+        assert process_png(path, smile).changed is False
+        with open(path, "wb") as f:
+            f.write(header + text_chunks["tEXt"][:-1])
+        assert process_png(path, smile).error.startswith("ValueError")
+    print("All png_metadata tests passed.")
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["--self-test"]:
+        _self_test()
+    else:
+        raise SystemExit(main())
@@ -0,0 +1,283 @@
+import re
+
+# Node kinds
+TEXT = "text"                    # Plain text, including escapes such as \( and surrounding whitespace
+EMPHASIS = "emphasis"            # (content) or (content:weight)
+DEEMPHASIS = "deemphasis"        # [content]
+SCHEDULED = "scheduled"          # [from:to:when] prompt editing or [a|b] alternation
+EXTRA_NETWORK = "extra_network"  # <lora:name:0.8>, <hypernet:name:1>, ...
+
+SEPARATOR_KEYWORDS = ("AND", "BREAK")
+
+# Same weight token as A1111's attention parser: ":1.2)" closes an emphasis with an explicit weight.
+_WEIGHT_CLOSE_PATTERN = re.compile(r":\s*([+-]?[.\d]+)\s*\)")
+# Runs of characters that are plain text in a given context, skipped in one regex step instead of char by char.
+# Commas, AND and BREAK only separate at the top level, ":" and the closing brackets only matter inside their
+# own kind of bracket, so e.g. a megabyte of commas inside a paren or of stray ")" is a single match.
+_PLAIN_TEXT_PATTERNS = {
+    None: re.compile(r"[^\\(\[<,AB]+"), # Top level; ")" and "]" are stray, hence text
+    EMPHASIS: re.compile(r"[^\\()\[<:]+"),
+    DEEMPHASIS: re.compile(r"[^\\(\[\]<:|]+"),
+    SCHEDULED: re.compile(r"[^\\(\[\]<]+"),
+}
+# ASCII word characters, none of which can start a keyword when they follow another word character.
+_WORD_TAIL_PATTERN = re.compile(r"[0-9A-Za-z_]*")
+# [^<>] rather than [^>] so a run of unterminated "<" cannot make matching quadratic.
+_EXTRA_NETWORK_PATTERN = re.compile(r"<\w+:[^<>]*>")
+
+
+class PromptNode:
+    """
+    A node of a parsed prompt. Offsets are relative to the start of the segment the node belongs to,
+    so a segment can move within the prompt without touching its nodes.
+    - kind: TEXT, EMPHASIS, DEEMPHASIS, SCHEDULED or EXTRA_NETWORK.
+    - start, end: Source span of the whole node, brackets and weight included.
+    - content_end: End of the content, i.e. where ":weight)" or the closing bracket starts.
+    - children: Nested nodes of bracket nodes, None for TEXT and EXTRA_NETWORK.
+    - weight: Explicit weight of "(content:weight)", None otherwise.
+    - closed: False for a bracket left open at the end of the prompt.
+    """
+    __slots__ = ("kind", "start", "end", "content_end", "children", "weight", "closed")
+
+    def __init__(self, kind: str, start: int, end: int = -1, children: list | None = None):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.content_end = end
+        self.children = children
+        self.weight = None
+        self.closed = True
+
+    def __repr__(self):
+        weight = f":{self.weight}" if self.weight is not None else ""
+        children = f" {self.children}" if self.children else ""
+        return f"<{self.kind} {self.start}-{self.end}{weight}{children}>"
+
+
+class ParsedPrompt:
+    """
+    A prompt split into top-level segments.
+    Segments are separated by commas outside any bracket and by the AND / BREAK keywords.
+    - separator_starts, separator_ends: Absolute spans of the separators, sorted.
+    - segments: Top-level nodes of every segment (one more than there are separators).
+    - open_brackets: Number of brackets left open at the end of the prompt.
+    """
+    __slots__ = ("text", "separator_starts", "separator_ends", "segments", "open_brackets")
+
+    def __init__(self, text: str, separator_starts: list[int], separator_ends: list[int], segments: list[list[PromptNode]], open_brackets: int = 0):
+        self.text = text
+        self.separator_starts = separator_starts
+        self.separator_ends = separator_ends
+        self.segments = segments
+        self.open_brackets = open_brackets
+
+
+def is_word_char(char: str) -> bool:
+    """Whether char can be part of a word, which a separator keyword must not be glued to."""
+    return char.isalnum() or char == "_"
+
+
+def _keyword_at(text: str, pos: int) -> str | None:
+    """Returns the separator keyword starting at pos if it stands as a whole word there."""
+    if pos > 0 and is_word_char(text[pos - 1]):
+        return None
+    for keyword in SEPARATOR_KEYWORDS:
+        end = pos + len(keyword)
+        if text.startswith(keyword, pos) and (end == len(text) or not is_word_char(text[end])):
+            return keyword
+    return None
+
+
+def parse_prompt(text: str) -> ParsedPrompt:
+    """
+    Parses a prompt in a single left-to-right pass, in time linear in its length.
+    Follows A1111's emphasis grammar: (a), (a:1.2), [a], escaped \\( \\) \\[ \\] \\\\, <extra:network>,
+    [from:to:when] and [a|b]. Brackets left open extend to the end of the prompt and swallow its separators,
+    while stray closing brackets are plain text.
+    """
+    separator_starts = []
+    separator_ends = []
+    segments = []
+
+    segment_start = 0
+    segment_nodes = []
+    children = segment_nodes # Node list currently being filled
+    open_nodes = []          # Stack of brackets not closed yet
+    text_start = -1          # Start of the pending text run, -1 if none
+    i = 0
+    n = len(text)
+
+    def flush_text(end):
+        nonlocal text_start
+        if text_start >= 0:
+            children.append(PromptNode(TEXT, text_start - segment_start, end - segment_start))
+            text_start = -1
+
+    def close_node(content_end, end):
+        nonlocal children
+        node = open_nodes.pop()
+        node.content_end = content_end - segment_start
+        node.end = end - segment_start
+        children = open_nodes[-1].children if open_nodes else segment_nodes
+        return node
+
+    # Every step consumes at least one character, and no regex match can scan past the next character
+    # that would end it, so the pass stays linear whatever the nesting or the number of separators.
+    while i < n:
+        innermost = open_nodes[-1] if open_nodes else None
+        plain = _PLAIN_TEXT_PATTERNS[innermost.kind if innermost is not None else None].match(text, i)
+        if plain:
+            if text_start < 0:
+                text_start = i
+            i = plain.end()
+            continue
+
+        char = text[i]
+
+        if char == "\\":
+            if text_start < 0:
+                text_start = i
+            i += 2 # The escaped character is text, whatever it is
+            continue
+
+        if char == "(" or char == "[":
+            flush_text(i)
+            while char == "(" or char == "[": # Open a whole run of brackets at once
+                node = PromptNode(EMPHASIS if char == "(" else DEEMPHASIS, i - segment_start, children=[])
+                children.append(node)
+                open_nodes.append(node)
+                children = node.children
+                i += 1
+                char = text[i] if i < n else ""
+            continue
+
+        if char == ":" and innermost is not None and innermost.kind == EMPHASIS:
+            match = _WEIGHT_CLOSE_PATTERN.match(text, i)
+            weight = None
+            if match:
+                try:
+                    weight = float(match.group(1))
+                except ValueError:
+                    pass # e.g. "1.2.3", which A1111 does not accept as a weight either
+            if weight is not None:
+                flush_text(i)
+                close_node(i, match.end()).weight = weight
+                i = match.end()
+                continue
+
+        elif char == ")" and innermost is not None and innermost.kind == EMPHASIS:
+            flush_text(i)
+            close_node(i, i + 1)
+            i += 1
+            continue
+
+        elif char == "]" and innermost is not None and innermost.kind != EMPHASIS:
+            flush_text(i)
+            close_node(i, i + 1)
+            i += 1
+            continue
+
+        elif (char == ":" or char == "|") and innermost is not None and innermost.kind == DEEMPHASIS:
+            innermost.kind = SCHEDULED # Still text, but the brackets no longer mean de-emphasis
+
+        elif char == "<":
+            match = _EXTRA_NETWORK_PATTERN.match(text, i)
+            if match:
+                flush_text(i)
+                children.append(PromptNode(EXTRA_NETWORK, i - segment_start, match.end() - segment_start))
+                i = match.end()
+                continue
+
+        elif innermost is None and (char == "," or ((char == "A" or char == "B") and _keyword_at(text, i))):
+            separator_end = i + 1 if char == "," else i + len(_keyword_at(text, i))
+            flush_text(i)
+            separator_starts.append(i)
+            separator_ends.append(separator_end)
+            segments.append(segment_nodes)
+            segment_nodes = []
+            children = segment_nodes
+            segment_start = separator_end
+            i = separator_end
+            continue
+
+        elif char == "A" or char == "B":
+            if text_start < 0:
+                text_start = i
+            i = _WORD_TAIL_PATTERN.match(text, i + 1).end() # The rest of the word cannot be a keyword either
+            continue
+
+        if text_start < 0:
+            text_start = i
+        i += 1
+
+    flush_text(n)
+    open_brackets = len(open_nodes)
+    for node in open_nodes:
+        node.content_end = node.end = n - segment_start
+        node.closed = False
+    segments.append(segment_nodes)
+    return ParsedPrompt(text, separator_starts, separator_ends, segments, open_brackets)
+
+
+def unwrap_weighted_nodes(text: str, nodes: list[PromptNode], offset: int = 0) -> tuple[int, int, float | None]:
+    """
+    Peels "(content:weight)" wrappers off a node list whose offsets are relative to offset in text,
+    as long as the list (ignoring whitespace around it) is exactly one such wrapper.
+    Returns the absolute (start, end) of the innermost content and the outermost weight (None if not weighted).
+    """
+    content_start, content_end = offset, offset + (nodes[-1].end if nodes else 0)
+    if nodes:
+        content_start += nodes[0].start
+    weight = None
+    while True:
+        significant = [node for node in nodes if node.kind != TEXT or not text[offset + node.start:offset + node.end].isspace()]
+        if len(significant) != 1:
+            break
+        node = significant[0]
+        if node.kind != EMPHASIS or node.weight is None:
+            break
+        if weight is None:
+            weight = node.weight
+        nodes = node.children
+        content_start, content_end = offset + node.start + 1, offset + node.content_end
+    return content_start, content_end, weight
+
+
+if __name__ == '__main__':
+    def run_parse_test(prompt, expected_segments):
+        parsed = parse_prompt(prompt)
+        bounds = [0] + parsed.separator_ends
+        ends = parsed.separator_starts + [len(prompt)]
+        segments = [prompt[start:end] for start, end in zip(bounds, ends)]
+        print(f"Prompt: '{prompt}'")
+        print(f"  -> Segments: {segments}")
+        assert segments == expected_segments
+        print("  OK")
+
+    run_parse_test("", [""])
+    run_parse_test("tag1, tag2", ["tag1", " tag2"])
+    run_parse_test("(a, b:1.2), [c, d], <lora:x,y:0.8>, e", ["(a, b:1.2)", " [c, d]", " <lora:x,y:0.8>", " e"])
+    run_parse_test("\\(a, b\\)", ["\\(a", " b\\)"]) # Escaped parens do not nest
+    run_parse_test("[from, x:to:0.4], [a|b]", ["[from, x:to:0.4]", " [a|b]"])
+    run_parse_test("a BREAK b AND c, ANDROID", ["a ", " b ", " c", " ANDROID"])
+    run_parse_test("a), b", ["a)", " b"]) # Stray closing paren is text
+    run_parse_test("a, (b, c", ["a", " (b, c"]) # Open paren swallows the rest
+
+    def run_unwrap_test(tag, expected_base, expected_weight):
+        parsed = parse_prompt(tag)
+        start, end, weight = unwrap_weighted_nodes(tag, parsed.segments[0])
+        print(f"Tag: '{tag}' -> base '{tag[start:end]}', weight {weight}")
+        assert tag[start:end].strip() == expected_base and weight == expected_weight
+        print("  OK")
+
+    run_unwrap_test("tag", "tag", None)
+    run_unwrap_test("(tag:1.2)", "tag", 1.2)
+    run_unwrap_test(" ( tag : 1.2 ) ", "tag", 1.2)
+    run_unwrap_test("((tag:0.5):1.5)", "tag", 1.5)
+    run_unwrap_test("(tag (with parens):1.1)", "tag (with parens)", 1.1)
+    run_unwrap_test("(a:1.1) (b:1.2)", "(a:1.1) (b:1.2)", None)
+    run_unwrap_test("(tag)", "(tag)", None)
+    run_unwrap_test("(:1.1)", "", 1.1)
+    run_unwrap_test("(tag:1.2.3)", "(tag:1.2.3)", None)
+
+    print("All prompt_parser tests passed.")
@@ -0,0 +1,355 @@
+import json
+import logging
+import math
+import time
+
+from .metrics import StageMetrics
+from .parse_cache import ParseCache, prompt_hash
+from .tag_utils import (
+    BULK_OPERATIONS, PromptSegmentIndex, apply_weight_to_segments, bulk_weight_transform, compact_segments, compaction_report,
+    transform_weights,
+)
+
+EXTENSION_NAME = "Custom Tag Weighting"
+
+COMPACT_DIRECTION = "compact"
+
+# Longest prompt a request may carry, far beyond any practical prompt (75-token chunks hold a few hundred
+# characters each). Longer ones are refused before they are parsed: even with linear parsing, a pasted megabyte
+# would hold a worker for seconds, while the adversarial corpus keeps requests at this length within budget.
+MAX_PROMPT_LENGTH = 1 << 15
+
+# Requests slower than SLOW_REQUEST_MS are logged with their stage timings, at most once per
+# SLOW_REQUEST_LOG_INTERVAL_S so a burst of them cannot flood the log.
+SLOW_REQUEST_MS = 100.0
+SLOW_REQUEST_LOG_INTERVAL_S = 10.0
+
+# Types of the request fields, checked before anything else reads them: requests come from any HTTP client.
+# Numbers must also be finite, as Python's json module accepts NaN and Infinity.
+_STRING_FIELDS = ("prompt_text", "direction")
+_INTEGER_FIELDS = ("cursor_pos_start", "cursor_pos_end", "decimals")
+_NUMBER_FIELDS = ("weight_step", "factor", "min_weight", "max_weight")
+
+logger = logging.getLogger(__name__)
+
+
+def _invalid_field(data: dict) -> str | None:
+    """Returns the error for the first request field of the wrong type, or None if they are all valid or absent."""
+    for name in _STRING_FIELDS:
+        if data.get(name) is not None and not isinstance(data[name], str):
+            return f"{name} must be a string"
+    for name in _INTEGER_FIELDS:
+        if data.get(name) is not None and (not isinstance(data[name], int) or isinstance(data[name], bool)):
+            return f"{name} must be an integer"
+    for name in _NUMBER_FIELDS:
+        value = data.get(name)
+        if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value)):
+            return f"{name} must be a finite number"
+    return None
+
+
+class TagWeightRequestHandler:
+    """
+    Processes tag weight requests, i.e. the payload the JavaScript client builds on Ctrl+Up/Down:
+    {"prompt_text", "cursor_pos_start", "cursor_pos_end", "direction", "weight_step", "seq"}.
+    The response has the new prompt and the exact selection to restore, {"new_prompt_text", "selection_start",
+    "selection_end"}. With a true "delta" it has a splice of the old prompt instead of the whole new one,
+    {"splice": {"start", "end", "replacement"}, "selection_start", "selection_end", "prompt_hash"}, and a later
+    request may then send that "prompt_hash" in place of "prompt_text" while the server still has it cached.
+    A "direction" of BULK_OPERATIONS ("scale", "clamp", "reset", "normalize", "round") rewrites the explicit weights
+    of every selected tag at once instead, or of the whole prompt without a selection, with that operation's
+    parameters (e.g. "factor") taken from the request. A "direction" of "compact" folds legacy emphasis stacks
+    such as "((((tag))))" into explicit weights over the same range, with optional "decimals", and adds the
+    savings to the response as "compaction" (see compaction_report).
+    An optional "seq" is echoed back unchanged in the response, and a true "timing" adds the server side
+    stage timings to it as "server_timings_us".
+    Prompts longer than max_prompt_length are refused with an error, so no request can hold a worker for long.
+    Shared by the hidden Gradio components and the HTTP/WebSocket routes, so every transport gets the same answers.
+    """
+
+    def __init__(self, parse_cache: ParseCache | None = None, max_prompt_length: int = MAX_PROMPT_LENGTH):
+        # Parsed prompts, shared by every session using this handler. Each edited prompt is put in it
+        # as soon as it is produced, so the next press on it finds it parsed already.
+        self.parse_cache = parse_cache if parse_cache is not None else ParseCache()
+        # Rolling latency histograms of each stage of a request, served by the status route.
+        self.metrics = StageMetrics()
+        self.max_prompt_length = max_prompt_length
+        self._last_slow_log_time = 0.0
+
+    def handle(self, data: dict) -> dict:
+        """Processes a decoded request and returns the response dict, an error response for malformed values."""
+        stage_ns = {}
+        start_ns = time.perf_counter_ns()
+        response = self._handle(data, stage_ns)
+        stage_ns["total"] = time.perf_counter_ns() - start_ns
+        self._record_stages(stage_ns)
+        return response
+
+    def _handle(self, data: dict, stage_ns: dict[str, int]) -> dict:
+        """handle() without recording: the duration of each stage is added to stage_ns instead."""
+        if not isinstance(data, dict):
+            logger.debug("%s: Tag weight request refused, not a JSON object.", EXTENSION_NAME)
+            return {"success": False, "error": "Request must be a JSON object", "new_prompt_text": ""}
+        error = _invalid_field(data)
+        if error is not None:
+            logger.debug("%s: Tag weight request refused, %s.", EXTENSION_NAME, error)
+            prompt_text = data.get("prompt_text")
+            return self._error_response(error, prompt_text if isinstance(prompt_text, str) else "", bool(data.get("delta")))
+        prompt_text = data.get("prompt_text")
+        cursor_pos = data.get("cursor_pos_start")
+        cursor_pos_end = data.get("cursor_pos_end")
+        direction = data.get("direction")
+        weight_step = float(data.get("weight_step", 0.1))
+        delta = bool(data.get("delta"))
+
+        start_ns = time.perf_counter_ns()
+        segment_index = None
+        if prompt_text is None and data.get("prompt_hash") is not None:
+            # The client only sent the hash of a prompt this server returned earlier.
+            try:
+                segment_index = self.parse_cache.get_by_hash(bytes.fromhex(data["prompt_hash"]))
+            except (TypeError, ValueError): # Not a hash this server could have sent, so not one it knows
+                segment_index = None
+            if segment_index is None:
+                return {"success": False, "error": "Unknown prompt hash", "unknown_prompt_hash": True}
+            prompt_text = segment_index.prompt_text
+
+        if prompt_text is None or cursor_pos is None or direction is None:
+            logger.debug("%s: Tag weight request missing parameters.", EXTENSION_NAME)
+            return self._error_response("Missing parameters", prompt_text if prompt_text is not None else "", delta)
+        if len(prompt_text) > self.max_prompt_length:
+            logger.debug("%s: Tag weight request refused, prompt of %d characters.", EXTENSION_NAME, len(prompt_text))
+            return self._error_response(f"Prompt longer than {self.max_prompt_length} characters", prompt_text, delta)
+
+        is_selection = cursor_pos_end is not None and cursor_pos_end != cursor_pos
+        is_bulk = direction in BULK_OPERATIONS or direction == COMPACT_DIRECTION
+        if segment_index is None:
+            segment_index = self.parse_cache.get_or_parse(prompt_text)
+        # A collapsed selection gives just the segment under the cursor, or every segment for bulk operations;
+        # a selection gives every segment it touches.
+        if is_selection:
+            tags = segment_index.get_tags_in_range(cursor_pos, cursor_pos_end)
+        elif is_bulk:
+            tags = segment_index.get_tags_in_range(0, len(prompt_text))
+        else:
+            tags = segment_index.get_tags_in_range(cursor_pos, cursor_pos)
+        lookup_end_ns = time.perf_counter_ns()
+        stage_ns["segment_lookup"] = lookup_end_ns - start_ns
+        new_prompt_text = None
+        compaction = None
+
+        if is_bulk:
+            tags = [tag for tag in tags if tag[0]] # A lone empty segment has no weight to rewrite
+        try:
+            if tags and direction == COMPACT_DIRECTION:
+                new_prompt_text, new_spans, folded = compact_segments(prompt_text, tags, data.get("decimals", 2), segment_index)
+                compaction = compaction_report(prompt_text, new_prompt_text, folded)
+            elif tags and is_bulk:
+                new_prompt_text, new_spans = transform_weights(
+                    prompt_text,
+                    tags,
+                    bulk_weight_transform(direction, data),
+                    segment_index=segment_index
+                )
+        except ValueError as e: # A parameter out of range, e.g. a scale factor of 0
+            logger.debug("%s: Tag weight request refused, %s.", EXTENSION_NAME, e)
+            return self._error_response(str(e), prompt_text, delta)
+        if tags and not is_bulk:
+            new_prompt_text, new_spans = apply_weight_to_segments(
+                prompt_text,
+                tags,
+                direction,
+                weight_step=weight_step,
+                segment_index=segment_index
+            )
+        if new_prompt_text is not None:
+            new_segment_index = segment_index.replaced(new_prompt_text, tags[0][1], tags[-1][2])
+            self.parse_cache.put(new_segment_index)
+            stage_ns["weight_apply"] = time.perf_counter_ns() - lookup_end_ns
+
+        if new_prompt_text is None:
+            logger.debug("%s: No tag found at cursor position %s in prompt %r", EXTENSION_NAME, cursor_pos, prompt_text)
+            return self._error_response("No tag found at cursor position", prompt_text, delta)
+
+        logger.debug("%s: Tag weighting applied to %d tag(s). Original: %r, New: %r", EXTENSION_NAME, len(tags), prompt_text, new_prompt_text)
+        if is_selection:
+            # Keep the reweighted tags selected, without the whitespace around them.
+            (first_start, first_end), (last_start, last_end) = new_spans[0], new_spans[-1]
+            first_text = new_prompt_text[first_start:first_end]
+            selection_start = first_start + len(first_text) - len(first_text.lstrip())
+            selection_end = last_start + len(new_prompt_text[last_start:last_end].rstrip())
+        else:
+            selection_start = selection_end = self._cursor_after(segment_index, new_segment_index, cursor_pos, tags, new_spans)
+
+        if not delta:
+            response = {"success": True, "new_prompt_text": new_prompt_text, "selection_start": selection_start, "selection_end": selection_end}
+            if compaction is not None:
+                response["compaction"] = compaction
+            return response
+
+        # Only the changed part goes back: the rewritten segments, minus what they share with the old ones at either end.
+        splice_start, old_end, new_end = tags[0][1], tags[-1][2], new_spans[-1][1]
+        while splice_start < old_end and splice_start < new_end and prompt_text[splice_start] == new_prompt_text[splice_start]:
+            splice_start += 1
+        while old_end > splice_start and new_end > splice_start and prompt_text[old_end - 1] == new_prompt_text[new_end - 1]:
+            old_end -= 1
+            new_end -= 1
+        response = {
+            "success": True,
+            "splice": {"start": splice_start, "end": old_end, "replacement": new_prompt_text[splice_start:new_end]},
+            "selection_start": selection_start,
+            "selection_end": selection_end,
+            "prompt_hash": prompt_hash(new_prompt_text).hex(),
+        }
+        if compaction is not None:
+            response["compaction"] = compaction
+        return response
+
+    @staticmethod
+    def _error_response(error: str, prompt_text: str, delta: bool) -> dict:
+        if delta:
+            return {"success": False, "error": error} # The client still has the prompt, no need to send it back
+        return {"success": False, "error": error, "new_prompt_text": prompt_text}
+
+    @classmethod
+    def _cursor_after(
+        cls,
+        segment_index: PromptSegmentIndex,
+        new_segment_index: PromptSegmentIndex,
+        cursor_pos: int,
+        tags: list[tuple[str, int, int]],
+        new_spans: list[tuple[int, int]]
+    ) -> int:
+        """Where a collapsed cursor goes once tags are rewritten into new_spans: see _moved_cursor for a rewritten tag under it."""
+        cursor_segment_start = segment_index.segment_bounds(segment_index.segment_of(cursor_pos))[0]
+        shift = 0
+        for (_, raw_start, raw_end), (new_start, new_end) in zip(tags, new_spans):
+            if raw_start == cursor_segment_start:
+                return cls._moved_cursor(segment_index, new_segment_index, cursor_pos, new_start)
+            if raw_end > cursor_pos:
+                break
+            shift += (new_end - new_start) - (raw_end - raw_start)
+        return cursor_pos + shift
+
+    @staticmethod
+    def _moved_cursor(segment_index: PromptSegmentIndex, new_segment_index: PromptSegmentIndex, cursor_pos: int, new_segment_start: int) -> int:
+        """
+        Where the cursor goes once the tag under it is reweighted: at the same offset in the tag's base text,
+        which the new weight moves but does not change. A cursor outside the base text, e.g. in the old weight,
+        ends up at the nearest end of it.
+        """
+        old_start, old_end = segment_index.segment_tag_span(segment_index.segment_of(cursor_pos))
+        new_start, new_end = new_segment_index.segment_tag_span(new_segment_index.segment_of(new_segment_start))
+        if new_end - new_start != old_end - old_start:
+            # The base text did not survive as is, e.g. an unclosed bracket now swallows the weight; keep the old offset.
+            return max(0, min(cursor_pos + len(new_segment_index.prompt_text) - len(segment_index.prompt_text), len(new_segment_index.prompt_text)))
+        return new_start + min(max(cursor_pos - old_start, 0), old_end - old_start)
+
+    def handle_json(self, request_json_str: str) -> str:
+        """Processes a JSON encoded request and returns the JSON encoded response. Never raises."""
+        try:
+            logger.debug("%s: Processing tag weight request: %s", EXTENSION_NAME, request_json_str)
+            stage_ns = {}
+            start_ns = time.perf_counter_ns()
+            data = json.loads(request_json_str)
+            stage_ns["json_parse"] = time.perf_counter_ns() - start_ns
+            response = self._handle(data, stage_ns)
+            if not isinstance(data, dict):
+                return json.dumps(response)
+            if "seq" in data:
+                response["seq"] = data["seq"] # Lets the client drop replies to requests it has superseded
+            if data.get("timing"):
+                response["server_timings_us"] = {stage: duration_ns // 1000 for stage, duration_ns in stage_ns.items()}
+            encode_start_ns = time.perf_counter_ns()
+            response_json = json.dumps(response)
+            end_ns = time.perf_counter_ns()
+            stage_ns["json_encode"] = end_ns - encode_start_ns
+            stage_ns["total"] = end_ns - start_ns
+            self._record_stages(stage_ns)
+            logger.debug("%s: Returning to JS: %s", EXTENSION_NAME, response_json)
+            return response_json
+
+        except Exception as e:
+            logger.error(f"{EXTENSION_NAME}: Error processing tag weight request: {e}", exc_info=True)
+            response = {"success": False, "error": str(e), "new_prompt_text": ""}
+            if isinstance(request_json_str, str):
+                try:
+                    data_for_error = json.loads(request_json_str)
+                    if data_for_error.get("delta"):
+                        del response["new_prompt_text"]
+                    else:
+                        response["new_prompt_text"] = data_for_error.get("prompt_text", "")
+                    if "seq" in data_for_error:
+                        response["seq"] = data_for_error["seq"]
+                except (json.JSONDecodeError, AttributeError):
+                    logger.warning(f"{EXTENSION_NAME}: Could not parse request_json_str in error handler: {request_json_str}")
+
+            response_json = json.dumps(response)
+            logger.debug("%s: Returning error to JS: %s", EXTENSION_NAME, response_json)
+            return response_json
+
+    def _record_stages(self, stage_ns: dict[str, int]) -> None:
+        for stage, duration_ns in stage_ns.items():
+            self.metrics.record_ns(stage, duration_ns)
+
+        total_ms = stage_ns["total"] / 1e6
+        if total_ms >= SLOW_REQUEST_MS:
+            now = time.monotonic()
+            if now - self._last_slow_log_time >= SLOW_REQUEST_LOG_INTERVAL_S:
+                self._last_slow_log_time = now
+                stages = ", ".join(f"{stage} {duration_ns / 1e6:.1f} ms" for stage, duration_ns in stage_ns.items() if stage != "total")
+                logger.warning("%s: Slow tag weight request, %.1f ms (%s)", EXTENSION_NAME, total_ms, stages)
+
+
+if __name__ == '__main__':
+    handler = TagWeightRequestHandler()
+
+    # The cursor keeps its offset in the base tag, or goes to the nearest end of it from inside the old weight.
+    assert handler.handle({"prompt_text": "tag1, tag2", "cursor_pos_start": 1, "direction": "up"}) == {
+        "success": True, "new_prompt_text": "(tag1:1.1), tag2", "selection_start": 2, "selection_end": 2
+    }
+    assert handler.handle({"prompt_text": "(tag:1.25)", "cursor_pos_start": 8, "direction": "down"})["selection_start"] == 4
+    # Bulk operations cover the whole prompt without a selection; the cursor follows its tag as the ones before it shrink.
+    bulk = handler.handle({"prompt_text": "(a:1.5), b, (c:2)", "cursor_pos_start": 15, "direction": "reset"})
+    assert (bulk["new_prompt_text"], bulk["selection_start"]) == ("a, b, c", 7)
+    assert handler.handle({"prompt_text": "(a:1.5), b, (c:2)", "cursor_pos_start": 10, "direction": "reset"})["selection_start"] == 4
+
+    # A selection is restored around the reweighted tags, without the whitespace between them and the separators.
+    selection = handler.handle({"prompt_text": "a, b, c", "cursor_pos_start": 0, "cursor_pos_end": 4, "direction": "up"})
+    assert (selection["new_prompt_text"], selection["selection_start"], selection["selection_end"]) == ("(a:1.1), (b:1.1), c", 0, 16)
+
+    # The splice leaves out what the old and new segment texts share at either end.
+    spliced = handler.handle({"prompt_text": "tag1, (tag2:1.1)", "cursor_pos_start": 13, "direction": "up", "delta": True})
+    assert spliced["splice"] == {"start": 14, "end": 15, "replacement": "2"} and spliced["selection_start"] == 11
+    assert spliced["prompt_hash"] == prompt_hash("tag1, (tag2:1.2)").hex()
+
+    # A later request can send the returned hash alone while the prompt is cached.
+    first = handler.handle({"prompt_text": "x, y", "cursor_pos_start": 0, "direction": "up", "delta": True})
+    assert first["splice"] == {"start": 0, "end": 1, "replacement": "(x:1.1)"}
+    second = handler.handle({"prompt_hash": first["prompt_hash"], "cursor_pos_start": 9, "direction": "up", "delta": True})
+    assert second["splice"] == {"start": 9, "end": 10, "replacement": "(y:1.1)"} and second["selection_start"] == 10
+    for unknown_hash in ("00" * 16, "zz", 12):
+        reply = json.loads(handler.handle_json(json.dumps({"prompt_hash": unknown_hash, "cursor_pos_start": 0, "direction": "up", "seq": 3})))
+        assert reply == {"success": False, "error": "Unknown prompt hash", "unknown_prompt_hash": True, "seq": 3}
+
+    # Malformed requests get a plain error reply, whatever client sent them.
+    for malformed, error in (
+        ("[1, 2]", "Request must be a JSON object"),
+        ("null", "Request must be a JSON object"),
+        ('{"prompt_text": "a, b", "cursor_pos_start": "1", "direction": "up"}', "cursor_pos_start must be an integer"),
+        ('{"prompt_text": "a, b", "cursor_pos_start": true, "direction": "up"}', "cursor_pos_start must be an integer"),
+        ('{"prompt_text": ["a"], "cursor_pos_start": 0, "direction": "up"}', "prompt_text must be a string"),
+        ('{"prompt_text": "a, b", "cursor_pos_start": 0, "direction": "up", "weight_step": NaN}', "weight_step must be a finite number"),
+        ('{"prompt_text": "a, b", "cursor_pos_start": 0, "direction": "scale", "factor": Infinity}', "factor must be a finite number"),
+        ('{"prompt_text": "a, b", "cursor_pos_start": 0, "direction": "scale", "factor": 0}', "factor must be greater than 0, got 0.0"),
+        ('{"prompt_text": "((((a))))", "cursor_pos_start": 0, "direction": "compact", "decimals": 0}', "decimals must be 1 or more, got 0"),
+    ):
+        reply = json.loads(handler.handle_json(malformed))
+        assert reply["success"] is False and reply["error"] == error, (malformed, reply)
+    assert handler.handle({"prompt_text": "a, b", "direction": "up"})["error"] == "Missing parameters"
+
+    long_prompt = "tag, " * (MAX_PROMPT_LENGTH // 5 + 1)
+    refused = handler.handle({"prompt_text": long_prompt, "cursor_pos_start": 0, "direction": "up", "delta": True})
+    assert refused == {"success": False, "error": f"Prompt longer than {MAX_PROMPT_LENGTH} characters"}
+    assert handler.handle({"prompt_text": long_prompt[:MAX_PROMPT_LENGTH], "cursor_pos_start": 0, "direction": "up"})["success"]
+    print("All request_handler tests passed.")
@@ -0,0 +1,209 @@
+import argparse
+import io
+import itertools
+import json
+import re
+import sys
+from collections.abc import Iterator, Sequence
+from typing import TextIO
+
+from .tag_utils import PromptSegmentIndex, format_weighted_tag, respaced_segment_text, splice_segments
+
+OUTPUT_FORMATS = ("jsonl", "a1111")
+
+
+def weight_range(start: float, stop: float, steps: int, decimals: int = 2) -> list[float]:
+    """steps weights evenly spaced from start to stop, both included, rounded to decimals."""
+    if steps < 1:
+        raise ValueError("A weight range needs at least one step")
+    if steps == 1:
+        return [round(start, decimals)]
+    return [round(start + (stop - start) * i / (steps - 1), decimals) for i in range(steps)]
+
+
+class WeightSweep:
+    """
+    Variants of one prompt with the weights of some of its tags swept over given values, in every combination.
+    The prompt is parsed once, into one slot per swept tag; a variant is then just the prompt spliced with the
+    tags formatted at its weights, and the variants are generated lazily, so the cartesian product of many
+    sweeps is never held in memory.
+    - sweeps: (tag_pattern, weights) pairs. tag_pattern is a regular expression matched against the whole tag
+      without its weight, as for batch reweighting; every top-level tag it matches gets the sweep's weights.
+      A tag matched by several patterns belongs to the first.
+    """
+
+    def __init__(self, prompt_text: str, sweeps: Sequence[tuple[str, Sequence[float]]]):
+        self.prompt_text = prompt_text
+        self.patterns = [pattern for pattern, _ in sweeps]
+        self.weights = [list(weights) for _, weights in sweeps]
+        tag_regexes = [re.compile(pattern) for pattern in self.patterns]
+
+        segment_index = PromptSegmentIndex(prompt_text)
+        self._slots: list[tuple[int, str, str, int, int]] = [] # (sweep, stripped tag, base tag, raw start, raw end)
+        for segment_idx in range(segment_index.segment_count):
+            raw_start, raw_end = segment_index.segment_bounds(segment_idx)
+            stripped_tag = prompt_text[raw_start:raw_end].strip()
+            if not stripped_tag:
+                continue
+            base_tag, _ = segment_index.segment_tag_weight(segment_idx)
+            sweep = next((sweep for sweep, tag_regex in enumerate(tag_regexes) if tag_regex.fullmatch(base_tag)), None)
+            if sweep is None:
+                continue
+            self._slots.append((sweep, stripped_tag, base_tag, raw_start, raw_end))
+        # Formatted segment text per slot and weight, filled on first use: a sweep repeats each weight many times.
+        self._formatted: list[dict[float, str]] = [{} for _ in self._slots]
+
+    @property
+    def matched_tags(self) -> list[int]:
+        """Number of tags each sweep matched, in the order of the sweeps."""
+        counts = [0] * len(self.patterns)
+        for sweep, *_ in self._slots:
+            counts[sweep] += 1
+        return counts
+
+    def __len__(self) -> int:
+        count = 1
+        for weights in self.weights:
+            count *= len(weights)
+        return count
+
+    def render(self, weights: Sequence[float]) -> str:
+        """The prompt with the tags of each sweep at the weight of the same position in weights."""
+        return splice_segments(self.prompt_text, (
+            (raw_start, raw_end, self._segment_text(slot_idx, weights[sweep]))
+            for slot_idx, (sweep, _, _, raw_start, raw_end) in enumerate(self._slots)
+        ))[0]
+
+    def _segment_text(self, slot_idx: int, weight: float) -> str:
+        segment_text = self._formatted[slot_idx].get(weight)
+        if segment_text is None:
+            _, stripped_tag, base_tag, raw_start, raw_end = self._slots[slot_idx]
+            new_tag_str = format_weighted_tag(base_tag, weight)
+            segment_text = respaced_segment_text(self.prompt_text, stripped_tag, raw_start, raw_end, new_tag_str)
+            self._formatted[slot_idx][weight] = segment_text
+        return segment_text
+
+    def __iter__(self) -> Iterator[tuple[tuple[float, ...], str]]:
+        """Yields (weights, prompt) for every combination of the sweeps' weights, the last sweep varying fastest."""
+        for weights in itertools.product(*self.weights):
+            yield weights, self.render(weights)
+
+
+def write_jsonl(sweep: WeightSweep, out: TextIO) -> int:
+    """Writes one {"prompt", "weights"} record per variant, weights keyed by tag pattern. Returns the variant count."""
+    count = 0
+    for weights, prompt in sweep:
+        out.write(json.dumps({"prompt": prompt, "weights": dict(zip(sweep.patterns, weights))}, ensure_ascii=False))
+        out.write("\n")
+        count += 1
+    return count
+
+
+def write_a1111_batch(sweep: WeightSweep, out: TextIO) -> int:
+    """
+    Writes one prompt per line, the format of A1111's "Prompts from file or textbox" script.
+    Line breaks within a prompt are replaced by spaces, as a line is a prompt there. Returns the variant count.
+    """
+    count = 0
+    for _, prompt in sweep:
+        out.write(" ".join(prompt.splitlines()))
+        out.write("\n")
+        count += 1
+    return count
+
+
+def _parse_sweep_arg(value: str) -> tuple[str, list[float]]:
+    """Parses PATTERN=START:STOP:STEPS or PATTERN=W1,W2,... into a sweep."""
+    pattern, separator, spec = value.rpartition("=")
+    if not separator or not pattern:
+        raise argparse.ArgumentTypeError(f"Expected PATTERN=START:STOP:STEPS or PATTERN=W1,W2,..., got {value!r}")
+    try:
+        re.compile(pattern)
+        if ":" in spec:
+            start, stop, steps = spec.split(":")
+            return pattern, weight_range(float(start), float(stop), int(steps))
+        return pattern, [float(weight) for weight in spec.split(",")]
+    except (re.error, ValueError) as e:
+        raise argparse.ArgumentTypeError(f"Invalid sweep {value!r}: {e}")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m sd_custom_tag_weighting.sweep",
+        description="Generate the variants of a prompt with tag weights swept over ranges, for A/B testing in batch runs."
+    )
+    prompt_source = parser.add_mutually_exclusive_group(required=True)
+    prompt_source.add_argument("-p", "--prompt", help="The prompt to sweep.")
+    prompt_source.add_argument("--prompt-file", help="File holding the prompt to sweep.")
+    parser.add_argument(
+        "-t", "--sweep", action="append", required=True, type=_parse_sweep_arg, metavar="PATTERN=WEIGHTS",
+        help="Tag pattern and its weights, as START:STOP:STEPS (e.g. \"blue hair=0.5:1.5:11\") or a list (\"smile=0.8,1,1.2\"). Repeat for a cartesian sweep."
+    )
+    parser.add_argument("-f", "--format", choices=OUTPUT_FORMATS, default="jsonl", help="jsonl records, or one prompt per line for A1111's prompts from file script (default: jsonl).")
+    parser.add_argument("-o", "--output", help="File to write the variants to (default: standard output).")
+    args = parser.parse_args(argv)
+
+    if args.prompt_file:
+        with open(args.prompt_file, encoding="utf-8") as f:
+            prompt_text = f.read().strip()
+    else:
+        prompt_text = args.prompt
+
+    sweep = WeightSweep(prompt_text, args.sweep)
+    for (pattern, _), matched in zip(args.sweep, sweep.matched_tags):
+        if not matched:
+            print(f"Warning: {pattern!r} matches no tag of the prompt.", file=sys.stderr)
+
+    writer = write_jsonl if args.format == "jsonl" else write_a1111_batch
+    if args.output:
+        with open(args.output, "w", encoding="utf-8", newline="\n") as out:
+            count = writer(sweep, out)
+    else:
+        count = writer(sweep, sys.stdout)
+    print(f"{count} variants written.", file=sys.stderr)
+    return 0
+
+
+def _self_test() -> None:
+    assert weight_range(0.5, 1.5, 3) == [0.5, 1.0, 1.5] and weight_range(0.8, 2, 1) == [0.8]
+    assert weight_range(1, 0, 4) == [1.0, 0.67, 0.33, 0.0]
+
+    sweep = WeightSweep("blue hair, 1girl, (smile:1.3), blue hair", [("blue hair", [0.5, 1.0]), ("smile", [1.2, 1.0]), ("cat", [2.0])])
+    assert sweep.matched_tags == [2, 1, 0] and len(sweep) == 4
+    # The last sweep varies fastest; the first tag of the prompt drops its whitespace as in apply_weight_to_tag.
+    assert list(sweep) == [
+        ((0.5, 1.2, 2.0), "(blue hair:0.5), 1girl, (smile:1.2), (blue hair:0.5)"),
+        ((0.5, 1.0, 2.0), "(blue hair:0.5), 1girl, smile, (blue hair:0.5)"),
+        ((1.0, 1.2, 2.0), "blue hair, 1girl, (smile:1.2), blue hair"),
+        ((1.0, 1.0, 2.0), "blue hair, 1girl, smile, blue hair"),
+    ]
+    # Each slot formats each of its weights once, however many variants use it.
+    assert sweep._formatted == [
+        {0.5: "(blue hair:0.5)", 1.0: "blue hair"}, {1.2: " (smile:1.2)", 1.0: " smile"}, {0.5: " (blue hair:0.5)", 1.0: " blue hair"}
+    ]
+    assert sweep.render((0.5, 1.0, 2.0)) == "(blue hair:0.5), 1girl, smile, (blue hair:0.5)"
+    assert len(sweep._formatted[0]) == 2
+
+    out = io.StringIO()
+    assert write_a1111_batch(WeightSweep("a,\nb", [("b", [1.1, 0.9])]), out) == 2
+    assert out.getvalue() == "a, (b:1.1)\na, (b:0.9)\n"
+    out = io.StringIO()
+    write_jsonl(WeightSweep("a, b", [("b", [1.1])]), out)
+    assert json.loads(out.getvalue()) == {"prompt": "a, (b:1.1)", "weights": {"b": 1.1}}
+
+    assert _parse_sweep_arg("blue hair=0.5:1.5:3") == ("blue hair", [0.5, 1.0, 1.5])
+    assert _parse_sweep_arg("a=b=0.8,1.2") == ("a=b", [0.8, 1.2])
+    for bad in ("smile", "=1", "smile=1:2", "(=1"):
+        try:
+            _parse_sweep_arg(bad)
+            raise AssertionError(f"{bad!r} was accepted")
+        except argparse.ArgumentTypeError:
+            pass
+    print("All sweep tests passed.")
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["--self-test"]:
+        _self_test()
+    else:
+        raise SystemExit(main())